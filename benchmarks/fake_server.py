@@ -0,0 +1,464 @@
+''' Local stand-in for the servers contacted by the SimNIBS installer
+
+Serves, on one port
+    /repos/simnibs/simnibs/releases: GitHub releases API for SimNIBS
+    /repos/simnibs/simnibs-installer/releases: releases API for the installer
+    /repos/<repo>/releases/assets/<id>: asset endpoint, redirecting to /download
+    /download/<name>: asset contents, with Range support
+    /miniconda/<name>: a fake Miniconda installer
+    /releases/tag/<tag>: release page, used by pip as find-links
+
+The fake Miniconda installer creates stubs for conda, pip and
+postinstall_simnibs, so that an install runs end to end without the real
+tools. Latency, bandwidth and dropped connections can be configured
+'''
+import hashlib
+import http.server
+import io
+import json
+import random
+import re
+import socketserver
+import sys
+import tarfile
+import threading
+import time
+import urllib.parse
+import zipfile
+
+
+CONDA_STUB = r'''
+import json
+import os
+import shutil
+import sys
+import time
+
+base = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+args = sys.argv[1:]
+if '-p' in args:
+    env = args[args.index('-p') + 1]
+else:
+    env = os.path.join(base, 'envs', 'simnibs_env')
+
+def env_file():
+    return args[args.index('-f') + 1]
+
+def dependencies(fn):
+    deps = []
+    with open(fn) as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith('- ') and not line.endswith(':'):
+                deps.append(line[2:].strip())
+    return deps
+
+def write_env(deps):
+    os.makedirs(os.path.join(env, 'bin'), exist_ok=True)
+    os.makedirs(os.path.join(env, 'conda-meta'), exist_ok=True)
+    for stub in ['pip', 'postinstall_simnibs']:
+        shutil.copy(os.path.join(base, 'stubs', stub), os.path.join(env, 'bin', stub))
+    packages = [
+        {'name': d.split('=')[0], 'version': (d.split('=') + ['1.0'])[1],
+         'build_string': '0', 'channel': 'fake'}
+        for d in deps]
+    with open(os.path.join(env, 'conda-meta', 'packages.json'), 'w') as f:
+        json.dump(packages, f)
+
+if args[:2] == ['env', 'update'] or args[:2] == ['env', 'create']:
+    time.sleep(float(os.environ.get('FAKE_CONDA_SOLVE_TIME', '0')))
+    write_env(dependencies(env_file()))
+elif args[:1] == ['install']:
+    time.sleep(float(os.environ.get('FAKE_CONDA_SOLVE_TIME', '0')) / 2)
+elif args[:1] == ['list']:
+    try:
+        with open(os.path.join(env, 'conda-meta', 'packages.json')) as f:
+            print(f.read())
+    except OSError:
+        print('[]')
+print('conda ' + ' '.join(args))
+'''
+
+PIP_STUB = r'''
+import os
+import re
+import sys
+import urllib.parse
+import urllib.request
+
+env = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+args = sys.argv[1:]
+find_links = args[args.index('-f') + 1].strip('"')
+if find_links.startswith('http'):
+    page = urllib.request.urlopen(find_links).read().decode()
+    wheel_url = urllib.parse.urljoin(
+        find_links, re.search(r'href="([^"]+\.whl)"', page).group(1))
+    wheel = urllib.request.urlopen(wheel_url).read()
+    name = wheel_url.rsplit('/', 1)[1]
+else:
+    name = [f for f in os.listdir(find_links) if f.endswith('.whl')][0]
+version = name.split('-')[1]
+with open(os.path.join(env, 'simnibs_version'), 'w') as f:
+    f.write(version)
+print('Successfully installed simnibs-' + version)
+'''
+
+POSTINSTALL_STUB = r'''
+import os
+import stat
+import sys
+
+env = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+args = sys.argv[1:]
+prefix = args[args.index('-d') + 1]
+with open(os.path.join(env, 'simnibs_version')) as f:
+    version = f.read().strip()
+os.makedirs(os.path.join(prefix, 'bin'), exist_ok=True)
+exe = os.path.join(prefix, 'bin', 'simnibs')
+with open(exe, 'w') as f:
+    f.write('#!/bin/sh\necho ' + version + '\n')
+os.chmod(exe, os.stat(exe).st_mode | stat.S_IXUSR)
+'''
+
+
+def _stub_script(name, source):
+    return (
+        f"cat > \"$PREFIX/stubs/{name}\" <<'STUB'\n"
+        f"#!{sys.executable}\n{source}\nSTUB\n"
+        f"chmod +x \"$PREFIX/stubs/{name}\"\n")
+
+
+def miniconda_installer(size):
+    ''' Fake Miniconda installer, padded to about size bytes '''
+    script = (
+        '#!/bin/bash\n'
+        '# Fake Miniconda installer generated by the benchmark server\n'
+        'while getopts "bfp:" opt; do\n'
+        '    case $opt in p) PREFIX="$OPTARG";; esac\n'
+        'done\n'
+        'mkdir -p "$PREFIX/bin" "$PREFIX/stubs" "$PREFIX/pkgs"\n'
+        + _stub_script('pip', PIP_STUB)
+        + _stub_script('postinstall_simnibs', POSTINSTALL_STUB)
+        + _stub_script('conda', CONDA_STUB)
+        + 'cp "$PREFIX/stubs/conda" "$PREFIX/bin/conda"\n'
+        'echo "export PATH=\\"$PREFIX/bin:\\$PATH\\"" > "$PREFIX/bin/activate"\n'
+        'exit 0\n'
+    ).encode()
+    # The real installer has a payload after the script, which is never run
+    n = max(size - len(script), 0)
+    return script + _random_bytes(random.Random(0), n)
+
+
+def _random_bytes(rng, n):
+    return rng.getrandbits(8 * n).to_bytes(n, 'little') if n > 0 else b''
+
+
+def documentation_zip(n_files, file_size, seed=0):
+    rng = random.Random(seed)
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as z:
+        for i in range(n_files):
+            z.writestr(f'html/page_{i:05d}.html', _random_bytes(rng, file_size))
+    return buffer.getvalue()
+
+
+def installer_archive():
+    buffer = io.BytesIO()
+    content = b'#!/bin/sh\necho new installer\n'
+    with tarfile.open(fileobj=buffer, mode='w:gz') as t:
+        info = tarfile.TarInfo('install_simnibs/install_simnibs')
+        info.size = len(content)
+        t.addfile(info, io.BytesIO(content))
+    return buffer.getvalue()
+
+
+class FakeGitHub:
+    ''' State of the fake servers
+
+    Parameters
+    ------------
+    versions: list
+        SimNIBS versions to publish, newest first
+    installer_versions: list
+        Published versions of the installer
+    n_releases: int
+        Total number of SimNIBS releases, padded with old versions (to
+        exercise pagination)
+    miniconda_size: int
+        Size of the fake Miniconda installer
+    docs_files, docs_file_size: int
+        Number and size of the files in documentation.zip
+    latency: float
+        Seconds to wait before answering each request
+    bandwidth: float
+        Bytes per second per connection, 0 for unlimited
+    failure_rate: float
+        Probability of dropping a download half way
+    '''
+    def __init__(self, versions=('4.0.1', '4.0.0'), installer_versions=('1.3',),
+                 n_releases=2, miniconda_size=20 * 1024 ** 2,
+                 docs_files=500, docs_file_size=4096,
+                 latency=0., bandwidth=0., failure_rate=0., seed=0):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.failure_rate = failure_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.counts = {}
+        self.bytes_sent = 0
+        self.files = {}
+        self.releases = {}
+        self.miniconda = miniconda_installer(miniconda_size)
+        docs = documentation_zip(docs_files, docs_file_size, seed)
+
+        versions = list(versions)
+        # Older versions, to fill up the number of releases
+        for i in range(n_releases - len(versions)):
+            versions.append(f'2.{i // 10}.{i % 10}')
+        versions.sort(key=lambda v: [int(x) for x in v.split('.')], reverse=True)
+        asset_id = 1
+        simnibs_releases = []
+        for version in versions:
+            tag = f'v{version}'
+            assets = []
+            contents = {
+                'environment_linux.yml':
+                    b'name: simnibs_env\nchannels:\n  - conda-forge\n'
+                    b'dependencies:\n  - python=3.9\n  - numpy\n'
+                    b'  - pip\n  - pip:\n    - nibabel\n',
+                'environment_macOS.yml': b'name: simnibs_env\n',
+                'environment_win.yml': b'name: simnibs_env\n',
+                'documentation.zip': docs,
+                f'simnibs-{version}-cp39-cp39-linux_x86_64.whl': _random_bytes(self.random, 1024 * 1024),
+            }
+            for name, content in contents.items():
+                assets.append(self._asset(
+                    'simnibs', asset_id, f'{tag}/{name}', name, content))
+                self.files[f'{tag}/{name}'] = content
+                asset_id += 1
+            simnibs_releases.append({
+                'tag_name': tag,
+                'prerelease': False,
+                'html_url': f'{{base}}/releases/tag/{tag}',
+                'assets': assets})
+        self.releases['simnibs'] = simnibs_releases
+
+        # The installer only updates itself if its own version is published
+        archive = installer_archive()
+        self.files['installer/install_simnibs_linux.tar.gz'] = archive
+        self.releases['simnibs-installer'] = [
+            {'tag_name': f'v{v}',
+             'prerelease': False,
+             'html_url': '{base}/installer',
+             'assets': [self._asset(
+                 'simnibs-installer', 1000 + i, 'installer/install_simnibs_linux.tar.gz',
+                 'install_simnibs_linux.tar.gz', archive)]}
+            for i, v in enumerate(installer_versions)]
+
+    def _asset(self, repo, asset_id, path, name, content):
+        return {
+            'id': asset_id,
+            'name': name,
+            'size': len(content),
+            'updated_at': '2024-01-01T00:00:00Z',
+            'browser_download_url': f'{{base}}/download/{path}',
+            '_path': path,
+            '_repo': repo,
+        }
+
+    def count(self, key, n=1):
+        with self.lock:
+            self.counts[key] = self.counts.get(key, 0) + n
+
+    def reset_counts(self):
+        with self.lock:
+            self.counts = {}
+            self.bytes_sent = 0
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counts)
+            stats['bytes_sent'] = self.bytes_sent
+        return stats
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    @property
+    def state(self):
+        return self.server.state
+
+    def _base(self):
+        return f'http://{self.server.server_address[0]}:{self.server.server_address[1]}'
+
+    def _send_json(self, data):
+        body = json.dumps(data).replace('{base}', self._base()).encode()
+        etag = '"' + hashlib.md5(body).hexdigest() + '"'
+        if self.headers.get('If-None-Match') == etag:
+            self.state.count('api_not_modified')
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        self.end_headers()
+        self._write(body, drop=False)
+
+    def _send_file(self, content, head=False):
+        etag = '"' + hashlib.md5(content[:1024 * 1024]).hexdigest() + str(len(content)) + '"'
+        start, end = 0, len(content) - 1
+        range_header = self.headers.get('Range')
+        if_range = self.headers.get('If-Range')
+        if range_header is not None and (if_range is None or if_range == etag):
+            m = re.match(r'bytes=(\d+)-(\d*)', range_header)
+            start = int(m.group(1))
+            if m.group(2):
+                end = min(int(m.group(2)), end)
+            if start > end:
+                self.send_response(416)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{end}/{len(content)}')
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(end + 1 - start))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('ETag', etag)
+        self.end_headers()
+        if not head:
+            self._write(content[start:end + 1], drop=True)
+
+    def _write(self, body, drop):
+        if drop and self.state.failure_rate > 0:
+            with self.state.lock:
+                dropped = self.state.random.random() < self.state.failure_rate
+            if dropped:
+                self.state.count('dropped_connections')
+                body = body[:len(body) // 2]
+                self.close_connection = True
+        block = 64 * 1024
+        for i in range(0, len(body), block):
+            chunk = body[i:i + block]
+            self.wfile.write(chunk)
+            with self.state.lock:
+                self.state.bytes_sent += len(chunk)
+            if self.state.bandwidth > 0:
+                time.sleep(len(chunk) / self.state.bandwidth)
+
+    def _not_found(self):
+        self.send_response(404)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_HEAD(self):
+        self.do_GET(head=True)
+
+    def do_GET(self, head=False):
+        if self.state.latency > 0:
+            time.sleep(self.state.latency)
+        url = urllib.parse.urlparse(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        path = url.path
+
+        m = re.match(r'^/repos/simnibs/([\w-]+)/releases$', path)
+        if m and m.group(1) in self.state.releases:
+            self.state.count('api')
+            releases = self.state.releases[m.group(1)]
+            per_page = int(query.get('per_page', ['30'])[0])
+            page = int(query.get('page', ['1'])[0])
+            self._send_json(releases[(page - 1) * per_page:page * per_page])
+            return
+
+        m = re.match(r'^/repos/simnibs/([\w-]+)/releases/assets/(\d+)$', path)
+        if m and m.group(1) in self.state.releases:
+            self.state.count('asset_redirects')
+            for release in self.state.releases[m.group(1)]:
+                for asset in release['assets']:
+                    if asset['id'] == int(m.group(2)):
+                        self.send_response(302)
+                        self.send_header('Location', f"{self._base()}/download/{asset['_path']}")
+                        self.send_header('Content-Length', '0')
+                        self.end_headers()
+                        return
+            self._not_found()
+            return
+
+        if path.startswith('/download/'):
+            content = self.state.files.get(path[len('/download/'):])
+            if content is None:
+                self._not_found()
+                return
+            self.state.count('downloads')
+            self._send_file(content, head)
+            return
+
+        if path.startswith('/miniconda/'):
+            self.state.count('miniconda')
+            self._send_file(self.state.miniconda, head)
+            return
+
+        m = re.match(r'^/releases/tag/(v[\w.]+)$', path)
+        if m:
+            self.state.count('find_links')
+            links = ''.join(
+                f'<a href="{self._base()}/download/{path}">{path.split("/")[-1]}</a>\n'
+                for path in self.state.files
+                if path.startswith(m.group(1) + '/') and path.endswith('.whl'))
+            body = f'<html><body>\n{links}</body></html>'.encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self._write(body, drop=False)
+            return
+
+        self._not_found()
+
+
+class _Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+def serve(state, host='127.0.0.1', port=0):
+    ''' Starts serving state in a background thread. Returns the server '''
+    server = _Server((host, port), _Handler)
+    server.state = state
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def configure_installer(installer, base_url):
+    ''' Points the installer module to the fake servers '''
+    installer.GH_RELEASES_URL = f'{base_url}/repos/simnibs/simnibs/releases'
+    installer.INSTALLER_RELEASES_URL = f'{base_url}/repos/simnibs/simnibs-installer/releases'
+    installer.MINICONDA_URL = f'{base_url}/miniconda'
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Runs the fake servers until interrupted')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--latency', type=float, default=0.)
+    parser.add_argument('--bandwidth', type=float, default=0.)
+    parser.add_argument('--failure-rate', type=float, default=0.)
+    args = parser.parse_args()
+    server = serve(
+        FakeGitHub(latency=args.latency, bandwidth=args.bandwidth,
+                   failure_rate=args.failure_rate),
+        port=args.port)
+    print(f'Serving on http://127.0.0.1:{server.server_address[1]}')
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
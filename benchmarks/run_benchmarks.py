@@ -0,0 +1,310 @@
+''' Benchmarks for the SimNIBS installer
+
+Runs the installer end to end against the local fake servers in
+fake_server.py, in a set of scenarios (fresh install, warm cache, no-op
+update, slow and flaky networks, self-update, ...). Each measured run is a
+separate process, so that no in-memory state carries over.
+
+Examples
+---------
+Run all the scenarios
+    python benchmarks/run_benchmarks.py
+
+Save the results, and later compare against them
+    python benchmarks/run_benchmarks.py --json before.json
+    python benchmarks/run_benchmarks.py --baseline before.json
+
+Only some of the scenarios
+    python benchmarks/run_benchmarks.py fresh warm_cache
+'''
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+sys.path.insert(0, os.path.dirname(HERE))
+
+import fake_server
+
+
+# Each scenario has
+#   server: arguments to FakeGitHub
+#   setup: runs done before the measured one, in the same prefix and cache
+#   run: the measured run
+#   env: extra environment variables (FAKE_CONDA_SOLVE_TIME is the time the
+#        fake conda takes to install the environment)
+# A run is a dictionary with "action" (install, self_update or conda_base,
+# which installs Miniconda outside of the prefix) and the arguments for it
+SCENARIOS = {
+    'fresh': {
+        'description': 'Install into an empty prefix, with an empty cache',
+        'server': {},
+        'setup': [],
+        'run': {'action': 'install'},
+    },
+    'warm_cache': {
+        'description': 'Install into an empty prefix, with the download cache populated',
+        'server': {},
+        'setup': [{'action': 'install', 'fresh_prefix': True}],
+        'run': {'action': 'install'},
+    },
+    'noop_update': {
+        'description': 'Run the installer again in a prefix which is up to date',
+        'server': {},
+        'setup': [{'action': 'install'}],
+        'run': {'action': 'install'},
+    },
+    'upgrade': {
+        'description': 'Update 4.0.0 -> 4.0.1 in the same prefix',
+        'server': {},
+        'setup': [{'action': 'install', 'version': '4.0.0'}],
+        'run': {'action': 'install', 'version': '4.0.1'},
+    },
+    'existing_conda': {
+        'description': 'Install using a conda install outside the prefix (--conda)',
+        'server': {},
+        'setup': [{'action': 'conda_base'}],
+        'run': {'action': 'install', 'use_conda_base': True},
+    },
+    'many_releases': {
+        'description': 'Fresh install, with 300 releases published (paginated API)',
+        'server': {'n_releases': 300},
+        'setup': [],
+        'run': {'action': 'install'},
+    },
+    'slow_network_1': {
+        'description': 'Fresh install, 50 ms latency and 5 MB/s per connection, 1 connection',
+        'server': {'latency': 0.05, 'bandwidth': 5 * 1024 ** 2},
+        'setup': [],
+        'run': {'action': 'install', 'connections': 1},
+    },
+    'slow_network_4': {
+        'description': 'Fresh install, 50 ms latency and 5 MB/s per connection, 4 connections',
+        'server': {'latency': 0.05, 'bandwidth': 5 * 1024 ** 2},
+        'setup': [],
+        'run': {'action': 'install', 'connections': 4},
+    },
+    'flaky_network': {
+        'description': 'Fresh install, 30% of the downloads are dropped half way',
+        'server': {'failure_rate': 0.3},
+        'setup': [],
+        'run': {'action': 'install'},
+    },
+    'slow_solver': {
+        'description': 'Fresh install, conda takes 2 s to install the environment',
+        'server': {},
+        'env': {'FAKE_CONDA_SOLVE_TIME': '2'},
+        'setup': [],
+        'run': {'action': 'install'},
+    },
+    'self_update': {
+        'description': 'Check for a newer installer, and download and stage it',
+        'server': {'installer_versions': ('1.4', '1.3')},
+        'setup': [],
+        'run': {'action': 'self_update'},
+    },
+}
+
+
+def _maxrss_bytes(maxrss):
+    # ru_maxrss is in kB on Linux and in bytes on macOS
+    return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+
+def _peak_rss():
+    ''' Peak RSS of this process
+
+    On Linux, ru_maxrss includes the memory of the benchmark process this one
+    was forked from, so we read VmHWM instead, which is reset on exec '''
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    if resource is None:
+        return 0
+    return _maxrss_bytes(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+
+
+def worker(config_fn):
+    ''' Does one run, in this process. Prints the results as JSON '''
+    with open(config_fn) as f:
+        config = json.load(f)
+    os.environ['SIMNIBS_INSTALLER_CACHE'] = config['cache']
+    import install_simnibs
+    fake_server.configure_installer(install_simnibs, config['base_url'])
+    install_simnibs.SOLVER = 'conda'
+    install_simnibs.PROFILE = True
+    install_simnibs.DOWNLOAD_CONNECTIONS = config.get(
+        'connections', install_simnibs.DOWNLOAD_CONNECTIONS)
+    install_simnibs.CONDA = config.get('conda')
+    install_simnibs._get_input = lambda message, silent: True
+    install_simnibs.logger.setLevel('WARNING')
+    install_simnibs.sh.setLevel('WARNING')
+
+    start = time.perf_counter()
+    if config['action'] == 'install':
+        install_simnibs.run_install(
+            config['prefix'], config.get('version', 'latest'), False, True)
+    elif config['action'] == 'conda_base':
+        install_simnibs._download_and_install_miniconda(config['conda_base'])
+    elif config['action'] == 'self_update':
+        install_simnibs.FILENAME = config['filename']
+        install_simnibs._stage_update()
+    else:
+        raise ValueError(f"Unknown action: {config['action']}")
+    wall_time = time.perf_counter() - start
+
+    result = {'wall_time': wall_time, 'peak_rss': _peak_rss()}
+    if resource is not None:
+        result['children_peak_rss'] = _maxrss_bytes(
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    report_fn = os.path.join(config['prefix'], 'simnibs_install_report.json')
+    if config['action'] == 'install' and os.path.isfile(report_fn):
+        with open(report_fn) as f:
+            report = json.load(f)
+        result['phases'] = {
+            phase['name']: phase['wall_time'] for phase in report.get('phases', [])}
+    print(json.dumps(result))
+
+
+def _run_worker(state, base_url, workdir, run, env, prefix, cache):
+    config = dict(run)
+    config.update({
+        'base_url': base_url,
+        'prefix': prefix,
+        'cache': cache,
+        'filename': os.path.join(workdir, 'install_simnibs'),
+        'conda_base': os.path.join(workdir, 'conda_base'),
+    })
+    if config.get('use_conda_base'):
+        config['conda'] = config['conda_base']
+    if config['action'] == 'self_update':
+        with open(config['filename'], 'w') as f:
+            f.write('#!/bin/sh\necho old installer\n')
+    config_fn = os.path.join(workdir, 'config.json')
+    with open(config_fn, 'w') as f:
+        json.dump(config, f)
+    state.reset_counts()
+    proc = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), '--worker', config_fn],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        universal_newlines=True, env=dict(os.environ, **env))
+    if proc.returncode != 0:
+        raise RuntimeError(f'Benchmark run failed:\n{proc.stderr}')
+    result = json.loads(proc.stdout.strip().splitlines()[-1])
+    result['server'] = state.stats()
+    return result
+
+
+def run_scenario(name, repeat=1):
+    ''' Runs a scenario repeat times. Returns the results of the fastest run '''
+    scenario = SCENARIOS[name]
+    state = fake_server.FakeGitHub(**scenario['server'])
+    server = fake_server.serve(state)
+    base_url = f'http://127.0.0.1:{server.server_address[1]}'
+    env = scenario.get('env', {})
+    results = []
+    try:
+        for _ in range(repeat):
+            workdir = tempfile.mkdtemp(prefix='simnibs_benchmark_')
+            try:
+                prefix = os.path.join(workdir, 'SimNIBS')
+                cache = os.path.join(workdir, 'cache')
+                for i, run in enumerate(scenario['setup']):
+                    setup_prefix = prefix
+                    if run.get('fresh_prefix'):
+                        setup_prefix = os.path.join(workdir, f'setup_{i}')
+                    _run_worker(state, base_url, workdir, run, env, setup_prefix, cache)
+                results.append(_run_worker(
+                    state, base_url, workdir, scenario['run'], env, prefix, cache))
+            finally:
+                shutil.rmtree(workdir, ignore_errors=True)
+    finally:
+        server.shutdown()
+        server.server_close()
+    return min(results, key=lambda r: r['wall_time'])
+
+
+def _format_bytes(n):
+    for unit in ['B', 'kB', 'MB', 'GB']:
+        if abs(n) < 1024 or unit == 'GB':
+            return f'{n:.1f} {unit}'
+        n /= 1024
+
+
+def print_results(results, baseline=None):
+    header = f"{'scenario':<16}{'wall time':>12}{'peak RSS':>12}{'requests':>10}{'downloaded':>13}"
+    if baseline:
+        header += f"{'vs baseline':>14}"
+    print(header)
+    print('-' * len(header))
+    for name, result in results.items():
+        server = result['server']
+        n_requests = sum(v for k, v in server.items() if k != 'bytes_sent')
+        line = (
+            f"{name:<16}{result['wall_time']:>11.2f}s"
+            f"{_format_bytes(result.get('peak_rss', 0)):>12}"
+            f"{n_requests:>10}{_format_bytes(server['bytes_sent']):>13}")
+        if baseline and name in baseline:
+            change = result['wall_time'] / baseline[name]['wall_time'] - 1
+            line += f'{change:>+13.0%}'
+        print(line)
+    print()
+    for name, result in results.items():
+        phases = result.get('phases')
+        if phases:
+            timings = ', '.join(f'{k} {v:.2f}s' for k, v in phases.items())
+            print(f'{name}: {timings}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks the SimNIBS installer')
+    parser.add_argument('scenarios', nargs='*',
+                        help='Scenarios to run. Default: all. Avaliable: '
+                             + ', '.join(SCENARIOS))
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='Runs of each scenario, the fastest is reported')
+    parser.add_argument('--json', metavar='FILE', help='Write the results to FILE')
+    parser.add_argument('--baseline', metavar='FILE',
+                        help='Compare against results written with --json')
+    parser.add_argument('--worker', metavar='CONFIG', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.worker is not None:
+        worker(args.worker)
+        return
+
+    names = args.scenarios or list(SCENARIOS)
+    for name in names:
+        if name not in SCENARIOS:
+            parser.error(f'Unknown scenario: {name}')
+    baseline = None
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    results = {}
+    for name in names:
+        print(f"{name}: {SCENARIOS[name]['description']}", file=sys.stderr)
+        results[name] = run_scenario(name, args.repeat)
+    print_results(results, baseline)
+    if args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -1 +1,6 @@
-pyinstaller --onefile --icon=gui_icon.ico --windowed --add-data="gui_icon.ico;." install_simnibs.py
+REM Run "compile.cmd headless" for a build without the GUI, which starts faster
+if "%1"=="headless" (
+    pyinstaller --onefile --exclude-module PyQt5 --name install_simnibs_headless install_simnibs.py
+) else (
+    pyinstaller --onefile --icon=gui_icon.ico --windowed --add-data="gui_icon.ico;." install_simnibs.py
+)
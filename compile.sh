@@ -1,2 +1,7 @@
 #! /bin/bash
-pyinstaller --onefile --windowed --icon=gui_icon.icns --add-data="gui_icon.ico:." install_simnibs.py
+# Run "bash compile.sh headless" for a build without the GUI, which starts faster
+if [ "$1" == "headless" ]; then
+    pyinstaller --onefile --exclude-module PyQt5 --name install_simnibs_headless install_simnibs.py
+else
+    pyinstaller --onefile --windowed --icon=gui_icon.icns --add-data="gui_icon.ico:." install_simnibs.py
+fi
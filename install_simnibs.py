@@ -8,19 +8,135 @@ import shutil
 import logging
 import re
 import zipfile
+import zlib
 import tempfile
+import pathlib
 import tarfile
 import stat
 import ctypes
 import gzip # Needed for self-update in linux
-
-import requests
-from PyQt5 import QtCore, QtWidgets, QtGui
+import concurrent.futures
+import json
+import hashlib
+import time
+import queue
+import threading
+import signal
+import contextlib
+import collections
+import urllib.parse
+try:
+    import resource
+except ImportError:
+    # Windows
+    resource = None
+
+from packaging.version import Version, InvalidVersion
+
+
+class _LazyModule:
+    ''' Module which is only imported when first used
+
+    import_func does the actual import, so that PyInstaller still finds it '''
+    def __init__(self, import_func):
+        self._import_func = import_func
+        self._module = None
+
+    def __getattr__(self, name):
+        if self._module is None:
+            self._module = self._import_func()
+        return getattr(self._module, name)
+
+def _import_requests():
+    import requests
+    return requests
+
+def _import_qt():
+    from PyQt5 import QtCore, QtWidgets, QtGui
+    return {'QtCore': QtCore, 'QtWidgets': QtWidgets, 'QtGui': QtGui}
+
+def _has_gui():
+    ''' False in the headless build, which does not include Qt '''
+    try:
+        _import_qt()
+    except ImportError:
+        return False
+    return True
+
+# The command line and silent installs never load Qt, and --version and
+# --help don't load requests either. The headless build has no Qt at all
+requests = _LazyModule(_import_requests)
+QtCore = _LazyModule(lambda: _import_qt()['QtCore'])
+QtWidgets = _LazyModule(lambda: _import_qt()['QtWidgets'])
+QtGui = _LazyModule(lambda: _import_qt()['QtGui'])
 
 #REMEMBER TO UPDATE THE VERSION HERE TOGETHER WITH THE RELEASE!
 __version__ = '1.3'
 
 GH_RELEASES_URL = 'https://api.github.com/repos/simnibs/simnibs/releases'
+INSTALLER_RELEASES_URL = 'https://api.github.com/repos/simnibs/simnibs-installer/releases'
+MINICONDA_URL = 'https://repo.continuum.io/miniconda'
+MICROMAMBA_URL = 'https://micro.mamba.pm/api/micromamba'
+# Directory or URL of an offline bundle to install from (set by --mirror)
+MIRROR = None
+# Solver for the environment, one of SOLVERS or 'auto' (set by --solver)
+SOLVER = 'auto'
+SOLVERS = ['conda', 'libmamba', 'mamba', 'micromamba']
+# Existing conda, mamba or micromamba install to create the environment with,
+# instead of installing Miniconda in the prefix (set by --conda)
+CONDA = None
+# Whether to ignore what previous, failed, installs completed (set by --restart)
+RESTART = False
+# How to install the documentation: 'full', 'lazy' (a stub page, the docs are
+# downloaded with update_simnibs --fetch-docs) or 'none'. None keeps the mode
+# of the previous install of the prefix, or 'full' (set by --docs)
+DOCS = None
+DOCS_MODES = ['full', 'lazy', 'none']
+DOCS_URL = 'https://simnibs.github.io/simnibs'
+# Whether to write a JSON report with the timings of each phase (set by --profile)
+PROFILE = False
+# Size of the blocks written to disk during downloads, in bytes
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+# Connect/read timeout for downloads, in seconds
+DOWNLOAD_TIMEOUT = 60
+# Lines of the install log shown in the GUI, and how often it is updated (ms)
+GUI_LOG_LINES = 5000
+GUI_LOG_INTERVAL = 100
+# Timeout for the release data fetched while the GUI opens, in seconds
+GUI_FETCH_TIMEOUT = 10
+# Retries of failed requests (connection errors, 429 and 5xx responses)
+HTTP_RETRIES = 5
+# Waits between retries grow as HTTP_BACKOFF * 2 ** retry seconds
+HTTP_BACKOFF = 0.5
+# Longest time, in seconds, to wait for the GitHub API rate limit to reset
+RATE_LIMIT_MAX_WAIT = 120
+# Timeout for the check for a newer installer, in seconds
+SELF_UPDATE_TIMEOUT = 5
+# Number of parallel connections used for large downloads (set by --connections)
+DOWNLOAD_CONNECTIONS = 4
+# Files smaller than this are downloaded over a single connection
+SEGMENTED_DOWNLOAD_MIN_SIZE = 16 * 1024 * 1024
+# Size of each byte range requested by the parallel downloader
+SEGMENT_SIZE = 8 * 1024 * 1024
+# Time, in seconds, during which cached release data is used without asking GitHub
+RELEASES_CACHE_TTL = 10 * 60
+# Number of releases requested per page of the GitHub API (maximum is 100)
+RELEASES_PER_PAGE = 100
+# Maximum number of output lines of a command waiting to be logged
+RUN_COMMAND_BUFFER = 1000
+# Size budget for the shared download cache, in bytes (set by --cache-size)
+DOWNLOAD_CACHE_SIZE = 2 * 1024 ** 3
+# Maximum number of install phases (downloads, conda, ...) running at once
+INSTALL_JOBS = 4
+# Size budget for the conda packages kept in the package cache which are not
+# used by the SimNIBS environment, in bytes (set by --pkgs-cache-size)
+PKGS_CACHE_SIZE = 1024 ** 3
+# Whether concurrent installs share one package cache (set by run_fleet)
+PKGS_SHARED = False
+# Number of SimNIBS versions whose wheels are kept in the wheelhouse
+WHEELHOUSE_VERSIONS = 3
+# Time window, in seconds, over which the download throughput is averaged
+PROGRESS_WINDOW = 5
 
 ENV=None
 if getattr( sys, 'frozen', False ):
@@ -54,6 +170,293 @@ sh.setLevel(logging.INFO)
 logger.addHandler(sh)
 logger.setLevel(logging.DEBUG)
 
+# State of the install running in the current thread. Helper threads copy it
+# from the thread starting them with _in_context
+_context = threading.local()
+
+def _in_context(func):
+    ''' Wraps func so that it runs with the context of the calling thread '''
+    state = dict(vars(_context))
+    def wrapped(*args, **kwargs):
+        vars(_context).update(state)
+        return func(*args, **kwargs)
+    return wrapped
+
+def _check_cancelled():
+    ''' Raises an OSError if the install running in this thread was
+    cancelled (see _run_phases). Long-running loops call this regularly '''
+    cancel = getattr(_context, 'cancel', None)
+    if cancel is not None and cancel.is_set():
+        raise OSError('Installation cancelled')
+
+class _ContextFilter(logging.Filter):
+    ''' Tags records with the prefix of the install running in the thread '''
+    def filter(self, record):
+        record.prefix = getattr(_context, 'prefix', None)
+        return True
+
+class _PrefixFilter(logging.Filter):
+    ''' Only lets through records of the install into prefix '''
+    def __init__(self, prefix):
+        super().__init__()
+        self.prefix = prefix
+
+    def filter(self, record):
+        return getattr(record, 'prefix', None) == self.prefix
+
+logger.addFilter(_ContextFilter())
+
+
+class InstallProfile:
+    ''' Wall time, bytes transferred and resource usage of the install phases
+
+    Phases are opened with _phase. Downloads and commands add their bytes and
+    child process usage to the innermost phase open in their thread '''
+    def __init__(self):
+        self.phases = []
+        self.start = time.time()
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        parent = getattr(_context, 'phase', None)
+        record = {
+            'name': name,
+            'parent': parent['name'] if parent is not None else None,
+            'status': 'ok',
+            'bytes': 0,
+            'child_cpu_time': 0.,
+            'child_peak_rss': 0,
+        }
+        _context.phase = record
+        start = time.perf_counter()
+        try:
+            yield record
+        except BaseException:
+            record['status'] = 'failed'
+            raise
+        finally:
+            record['wall_time'] = time.perf_counter() - start
+            record['throughput'] = (
+                record['bytes'] / record['wall_time'] if record['wall_time'] > 0 else 0.)
+            _context.phase = parent
+            with self._lock:
+                self.phases.append(record)
+
+    def add(self, key, value, combine=None):
+        ''' Adds value to the key of the current phase '''
+        record = getattr(_context, 'phase', None)
+        if record is None:
+            return
+        with self._lock:
+            if combine is None:
+                record[key] += value
+            else:
+                record[key] = combine(record[key], value)
+
+    def report(self):
+        report = {
+            'installer_version': __version__,
+            'platform': sys.platform,
+            'wall_time': time.time() - self.start,
+            'phases': self.phases,
+        }
+        if resource is not None:
+            report['installer_peak_rss'] = _maxrss_bytes(
+                resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+        return report
+
+    def write(self, fn):
+        with open(fn, 'w') as f:
+            json.dump(self.report(), f, indent=2)
+
+    def log_summary(self, log_level=logging.DEBUG):
+        for p in self.phases:
+            logger.log(
+                log_level,
+                f"{p['name']:<20} {p['wall_time']:8.1f} s "
+                f"{p['bytes'] / 1024 ** 2:10.1f} MB "
+                f"{p['throughput'] / 1024 ** 2:8.2f} MB/s "
+                f"cpu {p['child_cpu_time']:8.1f} s "
+                f"rss {p['child_peak_rss'] / 1024 ** 2:8.1f} MB "
+                f"{p['status']}")
+
+def _maxrss_bytes(maxrss):
+    # ru_maxrss is in bytes on macOS and in kB elsewhere
+    return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+def _phase(name):
+    ''' Context manager recording a phase in the profile of the current
+    install, if there is one '''
+    profile = getattr(_context, 'profile', None)
+    if profile is None:
+        return contextlib.suppress()
+    return profile.phase(name)
+
+def _count(key, value, combine=None):
+    profile = getattr(_context, 'profile', None)
+    if profile is not None:
+        profile.add(key, value, combine)
+
+
+class DownloadProgress:
+    ''' Bytes done, throughput and ETA of a download
+
+    The throughput is averaged over the last PROGRESS_WINDOW seconds. Updates
+    are passed to callback(phase, name, done, total, rate, eta) at most every
+    interval seconds, and always once the download finishes. total and eta
+    are -1 if unknown
+    '''
+    def __init__(self, name, total, callback, interval=0.2):
+        self.name = name
+        self.total = total if total is not None else -1
+        self.done = 0
+        self.callback = callback
+        self.interval = interval
+        phase = getattr(_context, 'phase', None)
+        self.phase = phase['name'] if phase is not None else ''
+        self._samples = collections.deque([(time.perf_counter(), 0)])
+        self._last_report = 0.
+        self._lock = threading.Lock()
+
+    def set_total(self, total):
+        with self._lock:
+            if self.total < 0:
+                self.total = total
+
+    def reset(self, done):
+        ''' Restarts counting at done bytes, e.g. when a transfer restarts '''
+        with self._lock:
+            self.done = done
+            self._samples = collections.deque([(time.perf_counter(), done)])
+
+    def add(self, n):
+        with self._lock:
+            self.done += n
+            now = time.perf_counter()
+            self._samples.append((now, self.done))
+            while len(self._samples) > 2 and now - self._samples[1][0] > PROGRESS_WINDOW:
+                self._samples.popleft()
+            if now - self._last_report < self.interval:
+                return
+            self._last_report = now
+            update = self._update()
+        self.callback(*update)
+
+    def finish(self):
+        with self._lock:
+            if self.total < 0:
+                self.total = self.done
+            update = self._update()
+        self.callback(*update)
+
+    def _update(self):
+        (t0, done0), (t1, done1) = self._samples[0], self._samples[-1]
+        rate = (done1 - done0) / (t1 - t0) if t1 > t0 else 0.
+        if self.total >= 0 and rate > 0:
+            eta = max(self.total - self.done, 0) / rate
+        else:
+            eta = -1.
+        return self.phase, self.name, self.done, self.total, rate, eta
+
+@contextlib.contextmanager
+def _download_progress(name, total=None):
+    ''' Tracks the progress of a download in the current thread, if someone
+    is listening (_context.on_progress) '''
+    callback = getattr(_context, 'on_progress', None)
+    if callback is None:
+        yield None
+        return
+    progress = DownloadProgress(name, total, callback)
+    previous = getattr(_context, 'download', None)
+    _context.download = progress
+    try:
+        yield progress
+        progress.finish()
+    finally:
+        _context.download = previous
+
+def _progress(n=None, total=None, reset=None):
+    ''' Updates the download running in the current thread '''
+    progress = getattr(_context, 'download', None)
+    if progress is None:
+        return
+    if total is not None:
+        progress.set_total(total)
+    if reset is not None:
+        progress.reset(reset)
+    if n is not None:
+        progress.add(n)
+
+def _format_size(n):
+    for unit in ['B', 'kB', 'MB', 'GB']:
+        if n < 1024 or unit == 'GB':
+            return f'{n:.1f} {unit}'
+        n /= 1024
+
+def _format_progress(phase, name, done, total, rate, eta):
+    message = f'{name}: {_format_size(done)}'
+    if total >= 0:
+        message += f' of {_format_size(total)}'
+        if total > 0:
+            message += f' ({100 * done / total:.0f}%)'
+    message += f', {_format_size(rate)}/s'
+    if eta >= 0:
+        message += f', {int(eta) // 60}:{int(eta) % 60:02d} left'
+    return message
+
+class CliProgress(logging.Filter):
+    ''' Prints download progress in the command line
+
+    On a terminal, while a single download runs, its line is rewritten in
+    place. Otherwise (with several downloads or installs running at once) a
+    log line is written per download at most every interval seconds. As a
+    filter of the console log handler, it clears the progress line before
+    each log record, so that the two don't mix '''
+    def __init__(self, interactive, interval=5.):
+        super().__init__()
+        self.interactive = interactive
+        self.interval = interval
+        # Time of the last update and of the last log line of each download
+        self._updated = {}
+        self._logged = {}
+        self._line_shown = False
+        self._lock = threading.Lock()
+
+    def __call__(self, phase, name, done, total, rate, eta):
+        finished = total >= 0 and done >= total
+        message = _format_progress(phase, name, done, total, rate, eta)
+        now = time.perf_counter()
+        with self._lock:
+            self._updated[name] = now
+            # Failed downloads don't finish, they just stop sending updates
+            self._updated = {
+                k: t for k, t in self._updated.items() if now - t < 2.}
+            n_running = len(self._updated)
+            if finished:
+                del self._updated[name]
+            if self.interactive and n_running == 1:
+                sys.stderr.write(f'\r{message:<79}' + ('\n' if finished else ''))
+                sys.stderr.flush()
+                self._line_shown = not finished
+                return
+            self._clear_line()
+            if finished or now - self._logged.get(name, 0.) < self.interval:
+                return
+            self._logged[name] = now
+        logger.info(message)
+
+    def _clear_line(self):
+        if self._line_shown:
+            sys.stderr.write('\r' + ' ' * 79 + '\r')
+            sys.stderr.flush()
+            self._line_shown = False
+
+    def filter(self, record):
+        with self._lock:
+            self._clear_line()
+        return True
+
 def log_excep(exc_type, exc_value, exc_traceback):
     if issubclass(exc_type, KeyboardInterrupt):
         sys.__excepthook__(exc_type, exc_value, exc_traceback)
@@ -66,69 +469,126 @@ def log_excep(exc_type, exc_value, exc_traceback):
 
 sys.excepthook = log_excep
 
-def self_update(silent):
-    ''' Updates the updater '''
-    installer_url = 'https://api.github.com/repos/simnibs/simnibs-installer/releases'
-    versions, data = _get_versions(installer_url)
-    try:
-        curr_idx = versions[__version__]
-        latest = curr_idx == 0
-    except KeyError:
-        latest = True
-    if latest:
-        return
-    else:
-        update = _get_input(
-            'Found a new version of the SimNIBS installer, update it?',
-            silent)
-    if not update:
-        return
-
-    logger.info('Updating the SimNIBS installer ...')
+def _installer_asset_name():
     if sys.platform == 'linux':
-        asset_name = 'install_simnibs_linux.tar.gz'
+        return 'install_simnibs_linux.tar.gz'
     elif sys.platform == 'darwin':
-        asset_name = 'install_simnibs_macOS.zip'
+        return 'install_simnibs_macOS.zip'
     elif sys.platform == 'win32':
-        asset_name = 'install_simnibs_windows.exe'
+        return 'install_simnibs_windows.exe'
     else:
         raise OSError('OS not supported')
 
-    tmp_fn = os.path.join(tempfile.gettempdir(), os.path.basename(FILENAME))
-    if os.path.isfile(tmp_fn):
-        os.remove(tmp_fn)
-    shutil.move(FILENAME, tmp_fn)
-    with tempfile.TemporaryDirectory() as tmpdir:
+def _update_dir():
+    ''' Where a newer installer is kept until the next launch '''
+    return os.path.join(_cache_dir(), 'installer_update')
+
+def _read_staged_update():
+    try:
+        with open(os.path.join(_update_dir(), 'staged.json'), 'r') as f:
+            staged = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not os.path.isfile(staged.get('file', '')):
+        return None
+    return staged
+
+def _stage_update():
+    ''' Downloads a newer version of the installer, if there is one, to be
+    used from the next launch on. Returns the staged version or None '''
+    # Never hold up the install waiting for GitHub
+    _context.http_timeout = SELF_UPDATE_TIMEOUT
+    catalogue = _get_catalogue(INSTALLER_RELEASES_URL)
+    if __version__ not in catalogue:
+        return None
+    latest_version = catalogue.latest()
+    if Version(latest_version) <= Version(__version__):
+        return None
+    staged = _read_staged_update()
+    if staged is not None and staged['version'] == latest_version:
+        return latest_version
+
+    logger.debug(f'Downloading version {latest_version} of the installer')
+    asset_name = _installer_asset_name()
+    target_dir = os.path.join(_update_dir(), latest_version)
+    os.makedirs(target_dir, exist_ok=True)
+    target = os.path.join(target_dir, 'install_simnibs' + os.path.splitext(FILENAME)[1])
+    with tempfile.TemporaryDirectory(dir=_update_dir()) as tmpdir:
         download_name = os.path.join(tmpdir, asset_name)
-        _download_asset(installer_url, data[0], asset_name, download_name)
+        _download_asset(catalogue, latest_version, asset_name, download_name)
         if sys.platform == 'win32':
-            shutil.move(download_name, FILENAME) 
+            shutil.move(download_name, target)
         elif sys.platform == 'darwin':
             with zipfile.ZipFile(download_name) as z:
                 z.extractall(tmpdir)
-            shutil.move(os.path.join(tmpdir, 'install_simnibs'), FILENAME) 
+            shutil.move(os.path.join(tmpdir, 'install_simnibs'), target)
         elif sys.platform == 'linux':
             with tarfile.open(download_name, 'r:gz') as t:
                 t.extractall(tmpdir)
-            shutil.move(os.path.join(tmpdir, 'install_simnibs', 'install_simnibs'), FILENAME) 
-
-        if sys.platform in ['linux', 'darwin']:
-            os.chmod(
-                FILENAME,
-                os.stat(FILENAME).st_mode |
-                stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+            shutil.move(os.path.join(tmpdir, 'install_simnibs', 'install_simnibs'), target)
+
+    if sys.platform in ['linux', 'darwin']:
+        os.chmod(
+            target,
+            os.stat(target).st_mode |
+            stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+    staged_fn = os.path.join(_update_dir(), 'staged.json')
+    with open(staged_fn + '.tmp', 'w') as f:
+        json.dump({'version': latest_version, 'file': target}, f)
+    os.replace(staged_fn + '.tmp', staged_fn)
+    return latest_version
+
+def _stage_update_worker():
+    # No progress output, it would mix with the install's
+    _context.on_progress = None
+    try:
+        version = _stage_update()
+    except Exception as e:
+        logger.debug(f'Could not check for installer updates: {e}')
+        return
+    if version is not None:
+        logger.info(
+            f'Version {version} of the SimNIBS installer was downloaded, '
+            'it will be used the next time the installer starts')
+
+def start_self_update():
+    ''' Checks for a newer installer in a background thread, which also
+    downloads and stages it. Returns the thread '''
+    thread = threading.Thread(target=_stage_update_worker, daemon=True)
+    thread.start()
+    return thread
+
+def apply_staged_update(silent, argv):
+    ''' Replaces the installer by a newer version staged in a previous run,
+    and restarts it with the arguments argv '''
+    staged = _read_staged_update()
+    if staged is None or Version(staged['version']) <= Version(__version__):
+        return
+    update = _get_input(
+        f'Version {staged["version"]} of the SimNIBS installer was '
+        'downloaded, update the installer?', silent)
+    if not update:
+        return
 
-    if silent:
-        logger.info('SimNIBS installer updated, please start it again')
-    else:
-        app = QtWidgets.QApplication(sys.argv)
-        QtWidgets.QMessageBox.information(
-            None, 'SimNIBS installer', 'SimNIBS installer updated, please start it again')
+    logger.info(f'Updating the SimNIBS installer to version {staged["version"]}')
+    # The running executable can't be overwritten in Windows, but can be moved
+    tmp_fn = os.path.join(tempfile.gettempdir(), os.path.basename(FILENAME))
+    if os.path.isfile(tmp_fn):
+        os.remove(tmp_fn)
+    shutil.move(FILENAME, tmp_fn)
+    shutil.copy2(staged['file'], FILENAME)
     try:
         os.remove(tmp_fn)
-    except:
+    except OSError:
         pass
-    sys.exit(0) #yes, I know...
+
+    if getattr(sys, 'frozen', False):
+        command = [FILENAME] + argv
+    else:
+        command = [sys.executable, FILENAME] + argv
+    if sys.platform == 'win32':
+        sys.exit(subprocess.call(command))
+    os.execv(command[0], command)
 
 def _get_input(message, silent):
     '''Simple function to get user input via command line or GUI '''
@@ -151,21 +611,289 @@ def _get_input(message, silent):
 
 
 
-def _get_versions(url, pre_release=False):
-    ''' Get avaliable versions and release data'''
-    response = requests.get(url)
-    # Raise an exception if the API call fails.
-    response.raise_for_status()
-    data = response.json()
-    versions = {}
-    for i, d in enumerate(data):
-        if d['tag_name'][0] == 'v':
-            if not d['prerelease']:
-                versions[d['tag_name'][1:]] = i
-            if d['prerelease'] and pre_release:
-                versions[d['tag_name'][1:]] = i
+def _cache_dir():
+    ''' Directory for data kept between installer runs '''
+    if 'SIMNIBS_INSTALLER_CACHE' in os.environ:
+        return os.environ['SIMNIBS_INSTALLER_CACHE']
+    if sys.platform == 'win32':
+        base = os.environ.get('LOCALAPPDATA', tempfile.gettempdir())
+    elif sys.platform == 'darwin':
+        base = os.path.join(os.path.expanduser('~'), 'Library', 'Caches')
+    else:
+        base = os.environ.get(
+            'XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache'))
+    return os.path.join(base, 'simnibs-installer')
+
+# Shared sessions, with and without retries
+_sessions = {}
+_session_lock = threading.Lock()
+
+def _get_session(retries=True):
+    ''' requests session shared by all the network calls, so that connections
+    are kept alive. Transient errors (429 and 5xx) are retried with
+    exponential backoff, honouring Retry-After
+
+    With retries=False nothing is retried, for requests which must finish
+    within their timeout '''
+    with _session_lock:
+        if retries not in _sessions:
+            from urllib3.util.retry import Retry
+            n_retries = HTTP_RETRIES if retries else 0
+            retry_args = dict(
+                total=n_retries, connect=n_retries, read=n_retries,
+                status=n_retries, backoff_factor=HTTP_BACKOFF,
+                status_forcelist=[429, 500, 502, 503, 504],
+                respect_retry_after_header=True, raise_on_status=False)
+            try:
+                retry = Retry(allowed_methods=['GET', 'HEAD'], **retry_args)
+            except TypeError:
+                # urllib3 < 1.26
+                retry = Retry(method_whitelist=['GET', 'HEAD'], **retry_args)
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=10,
+                pool_maxsize=max(DOWNLOAD_CONNECTIONS, 10),
+                max_retries=retry)
+            session = requests.Session()
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            session.headers['User-Agent'] = f'simnibs-installer/{__version__}'
+            _sessions[retries] = session
+        return _sessions[retries]
+
+def _github_token():
+    return os.environ.get('GITHUB_TOKEN') or os.environ.get('GH_TOKEN')
+
+def _http_request(method, url, headers=None, **kwargs):
+    ''' Sends a request through the shared session
+
+    GitHub API requests carry the token in GITHUB_TOKEN or GH_TOKEN, if set.
+    When the GitHub rate limit is exceeded, waits until it resets if that is
+    less than RATE_LIMIT_MAX_WAIT seconds away. If the current thread has a
+    _context.http_timeout, the request is neither retried nor waits, so that
+    it fails within the timeout '''
+    bounded = getattr(_context, 'http_timeout', None) is not None
+    headers = dict(headers or {})
+    token = _github_token()
+    if token and urllib.parse.urlparse(url).hostname == 'api.github.com':
+        headers['Authorization'] = f'token {token}'
+    while True:
+        response = _get_session(not bounded).request(
+            method, url, headers=headers, **kwargs)
+        if (response.status_code not in [403, 429] or
+                response.headers.get('X-RateLimit-Remaining') != '0'):
+            return response
+        reset = int(response.headers.get('X-RateLimit-Reset', 0))
+        wait = max(reset - time.time(), 0) + 1
+        if wait > RATE_LIMIT_MAX_WAIT or bounded:
+            response.close()
+            message = (
+                f'GitHub API rate limit exceeded, it resets at '
+                f'{time.strftime("%H:%M:%S", time.localtime(reset))}')
+            if not token:
+                message += '. Set GITHUB_TOKEN to get a higher limit'
+            # An HTTPError (also an OSError), so that callers with cached
+            # data fall back to it
+            raise requests.exceptions.HTTPError(message, response=response)
+        logger.warn(f'GitHub API rate limit exceeded, waiting {wait:.0f} s')
+        response.close()
+        time.sleep(wait)
+
+def _http_get(url, **kwargs):
+    return _http_request('GET', url, **kwargs)
+
+# Responses already fetched in this run, by URL
+_json_memo = {}
+
+def _get_json(url):
+    ''' GETs a JSON document, caching it in memory and on disk
+
+    Cached documents younger than RELEASES_CACHE_TTL are used directly. Older
+    ones are revalidated with If-None-Match, so an unchanged document costs
+    a 304 response. If GitHub can't be reached, stale data is used. The
+    timeout can be shortened for the current thread with _context.http_timeout
+    '''
+    if url in _json_memo:
+        return _json_memo[url]
+    cache_fn = os.path.join(
+        _cache_dir(), 'http', hashlib.sha1(url.encode()).hexdigest() + '.json')
+    cached = None
+    try:
+        with open(cache_fn, 'r') as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        pass
+    if cached is not None and time.time() - cached['time'] < RELEASES_CACHE_TTL:
+        _json_memo[url] = cached['data']
+        return cached['data']
 
-    return versions, data
+    headers = {}
+    if cached is not None and cached.get('etag'):
+        headers['If-None-Match'] = cached['etag']
+    try:
+        response = _http_get(
+            url, headers=headers,
+            timeout=getattr(_context, 'http_timeout', None) or DOWNLOAD_TIMEOUT)
+        # Raise an exception if the API call fails.
+        response.raise_for_status()
+    except requests.exceptions.RequestException as e:
+        if cached is None:
+            raise
+        logger.warn(f'Could not reach {url} ({e}), using cached data')
+        _json_memo[url] = cached['data']
+        return cached['data']
+
+    etag = response.headers.get('ETag')
+    _count('bytes', len(response.content))
+    if response.status_code == 304:
+        logger.debug(f'{url} not modified, using cached data')
+        data = cached['data']
+        etag = etag or cached['etag']
+    else:
+        data = response.json()
+    entry = {
+        'url': url,
+        'etag': etag,
+        'time': time.time(),
+        'data': data
+    }
+    try:
+        os.makedirs(os.path.dirname(cache_fn), exist_ok=True)
+        with open(cache_fn + '.tmp', 'w') as f:
+            json.dump(entry, f)
+        os.replace(cache_fn + '.tmp', cache_fn)
+    except OSError as e:
+        logger.debug(f'Could not write the release cache: {e}')
+    _json_memo[url] = data
+    return data
+
+class ReleaseCatalogue:
+    ''' Index of the releases in a GitHub repository
+
+    Pages of the releases API are only fetched when needed: looking up a
+    version stops at the page where its tag is found. Releases are indexed
+    by their PEP 440 version, so lookups are O(1) and ordering follows real
+    version comparison rather than the order returned by the API
+
+    Parameters
+    ------------
+    url: str
+        URL of the releases API
+    pre_release: bool
+        Whether to include pre-releases
+    '''
+    def __init__(self, url, pre_release=False):
+        self.url = url
+        self.pre_release = pre_release
+        self._lock = threading.RLock()
+        self._releases = {}
+        self._assets = {}
+        self._first_version = None
+        self._next_page = 1
+        self._complete = False
+
+    def _fetch_next_page(self):
+        ''' Adds the next page of releases to the index. Returns False if
+        there are no pages left '''
+        if self._complete:
+            return False
+        if MIRROR is not None and self.url == GH_RELEASES_URL:
+            data = _read_mirror_json('releases.json')
+            self._complete = True
+        else:
+            data = _get_json(
+                f'{self.url}?per_page={RELEASES_PER_PAGE}&page={self._next_page}')
+            self._next_page += 1
+            if len(data) < RELEASES_PER_PAGE:
+                self._complete = True
+        for d in data:
+            if not d['tag_name'].startswith('v'):
+                continue
+            if d['prerelease'] and not self.pre_release:
+                continue
+            try:
+                version = Version(d['tag_name'][1:])
+            except InvalidVersion:
+                logger.debug(f"Ignoring release with invalid tag: {d['tag_name']}")
+                continue
+            if version in self._releases:
+                continue
+            self._releases[version] = d
+            self._assets[version] = {asset['name']: asset for asset in d['assets']}
+            if self._first_version is None:
+                self._first_version = version
+        return len(data) > 0
+
+    def _lookup(self, version):
+        try:
+            version = Version(version)
+        except InvalidVersion:
+            raise KeyError(version)
+        with self._lock:
+            while version not in self._releases:
+                if not self._fetch_next_page():
+                    raise KeyError(str(version))
+        return version
+
+    def release(self, version):
+        ''' Release data for the given version. Raises a KeyError if there is
+        no such release '''
+        return self._releases[self._lookup(version)]
+
+    def asset(self, version, asset_name):
+        ''' Asset data for asset_name in the given version, or None '''
+        return self._assets[self._lookup(version)].get(asset_name)
+
+    def asset_names(self, version):
+        ''' Names of the assets of the given version '''
+        return list(self._assets[self._lookup(version)])
+
+    def latest(self):
+        ''' Latest version
+
+        The newest release is always in the first page of the API, so only
+        the pages fetched so far (at least one) are considered '''
+        with self._lock:
+            while self._first_version is None:
+                if not self._fetch_next_page():
+                    raise ValueError(f'Could not find any releases in {self.url}')
+            return self._releases[max(self._releases)]['tag_name'][1:]
+
+    def versions(self):
+        ''' All avaliable versions, newest first. Fetches all pages '''
+        with self._lock:
+            while self._fetch_next_page():
+                pass
+        return [
+            self._releases[v]['tag_name'][1:]
+            for v in sorted(self._releases, reverse=True)
+        ]
+
+    def __contains__(self, version):
+        try:
+            self._lookup(version)
+        except KeyError:
+            return False
+        return True
+
+
+# Catalogues already created in this run
+_catalogues = {}
+_catalogues_lock = threading.Lock()
+
+def _get_catalogue(url, pre_release=False):
+    ''' Returns the ReleaseCatalogue for url, creating it on the first call '''
+    key = (url, pre_release)
+    with _catalogues_lock:
+        if key not in _catalogues:
+            _catalogues[key] = ReleaseCatalogue(url, pre_release)
+        return _catalogues[key]
+
+def _parse_version(version):
+    ''' Parses a version string, returning None if it is not a valid version '''
+    try:
+        return Version(version)
+    except (InvalidVersion, TypeError):
+        return None
 
 def _simnibs_exe(prefix):
     if sys.platform == 'win32':
@@ -188,48 +916,605 @@ def _get_current_version(prefix):
         return None
     return res.rstrip('\n').rstrip('\r')
 
-def _download_asset(url, release_data, asset_name, fn):
-    dl_header = {'Accept': 'application/octet-stream'}
-    for asset in release_data['assets']:
-        if asset['name'] == asset_name:
-            r = requests.get(
-                f'{url}/assets/{asset["id"]}',
-                headers=dl_header, allow_redirects=True)
-            r.raise_for_status()
-            with open(fn, 'wb') as f:
-                f.write(r.content)
+def _range_validator(response_headers):
+    ''' Validator for If-Range: the ETag, unless it is weak (which If-Range
+    doesn't allow), or the Last-Modified date '''
+    etag = response_headers.get('ETag')
+    if etag is not None and not etag.startswith('W/'):
+        return etag
+    return response_headers.get('Last-Modified')
+
+def _download_stream(url, fn, headers=None, max_retries=5):
+    ''' Streams a download to disk in chunks, resuming it if interrupted
+
+    The data is written to "fn.part" and only moved to "fn" once complete.
+    Interrupted transfers are continued with HTTP Range requests, also across
+    runs, as long as the server reports the same ETag/Last-Modified.
+    Returns the SHA-256 of the file, computed as the data arrives
+    '''
+    part_fn = fn + '.part'
+    validator_fn = part_fn + '.validator'
+    headers = dict(headers or {})
+    validator = None
+    if os.path.isfile(part_fn) and os.path.isfile(validator_fn):
+        with open(validator_fn, 'r') as f:
+            validator = f.read().strip() or None
+    elif os.path.isfile(part_fn):
+        os.remove(part_fn)
+
+    sha256 = None
+    for attempt in range(max_retries + 1):
+        pos = os.path.getsize(part_fn) if os.path.isfile(part_fn) else 0
+        req_headers = dict(headers)
+        if pos > 0 and validator is not None:
+            req_headers['Range'] = f'bytes={pos}-'
+            req_headers['If-Range'] = validator
+        else:
+            pos = 0
+        try:
+            with _http_get(
+                    url, headers=req_headers, stream=True,
+                    allow_redirects=True, timeout=DOWNLOAD_TIMEOUT) as r:
+                if pos > 0 and r.status_code == 416:
+                    # We already have all the bytes
+                    total = -1
+                    break
+                r.raise_for_status()
+                if r.status_code == 206:
+                    mode = 'ab'
+                    total = int(r.headers['Content-Range'].rsplit('/', 1)[1])
+                    _progress(total=total, reset=pos)
+                    logger.debug(f'Resuming download of {url} at byte {pos}')
+                    if sha256 is None:
+                        # Resuming a download from a previous run
+                        sha256 = _hash_file(part_fn)
+                else:
+                    mode = 'wb'
+                    pos = 0
+                    total = int(r.headers.get('Content-Length', -1))
+                    sha256 = hashlib.sha256()
+                    _progress(total=total if total >= 0 else None, reset=0)
+                validator = _range_validator(r.headers)
+                if validator is not None:
+                    with open(validator_fn, 'w') as f:
+                        f.write(validator)
+                with open(part_fn, mode) as f:
+                    for chunk in r.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                        _check_cancelled()
+                        f.write(chunk)
+                        sha256.update(chunk)
+                        _count('bytes', len(chunk))
+                        _progress(len(chunk))
+        except (requests.exceptions.ConnectionError,
+                requests.exceptions.ChunkedEncodingError,
+                requests.exceptions.Timeout) as e:
+            if attempt == max_retries:
+                raise
+            logger.warn(f'Download interrupted ({e}), retrying')
+            continue
+        if total < 0 or os.path.getsize(part_fn) == total:
+            break
+        if attempt == max_retries:
+            raise IOError(f'Incomplete download: {url}')
+        logger.warn('Download incomplete, retrying')
+
+    if sha256 is None:
+        sha256 = _hash_file(part_fn)
+    os.replace(part_fn, fn)
+    if os.path.isfile(validator_fn):
+        os.remove(validator_fn)
+    return sha256.hexdigest()
+
+def _hash_file(fn, start=0, end=None, sha256=None):
+    ''' Updates (or creates) a SHA-256 object with the bytes start-end
+    (exclusive) of fn '''
+    sha256 = sha256 or hashlib.sha256()
+    with open(fn, 'rb') as f:
+        f.seek(start)
+        remaining = end - start if end is not None else None
+        while remaining is None or remaining > 0:
+            size = DOWNLOAD_CHUNK_SIZE
+            if remaining is not None:
+                size = min(size, remaining)
+                remaining -= size
+            block = f.read(size)
+            if not block:
+                break
+            sha256.update(block)
+    return sha256
+
+class _RedirectedUrl:
+    ''' URL a download was redirected to, resolved again when it expires
+
+    The segments of a download go straight to the redirect target, so that
+    they don't count against the GitHub API rate limit. GitHub redirects to
+    signed CDN URLs which expire after a few minutes
+    '''
+    def __init__(self, url, resolved, headers):
+        self.url = url
+        self.resolved = resolved
+        self.headers = headers
+        self._lock = threading.Lock()
+
+    def refresh(self, expired):
+        ''' Resolves url again, unless another segment already did since
+        expired failed. Returns False if url is not redirected '''
+        with self._lock:
+            if self.resolved == self.url:
+                return False
+            if self.resolved == expired:
+                logger.debug(f'{expired} was rejected, resolving {self.url} again')
+                probe_headers = dict(self.headers)
+                probe_headers['Range'] = 'bytes=0-0'
+                with _http_get(
+                        self.url, headers=probe_headers, stream=True,
+                        allow_redirects=True, timeout=DOWNLOAD_TIMEOUT) as r:
+                    r.raise_for_status()
+                    self.resolved = r.url
+            return True
+
+def _download_range(source, fn, start, end, headers, max_retries=5):
+    ''' Downloads the bytes start-end (inclusive) of source (a _RedirectedUrl)
+    into the same position of the (preallocated) file fn '''
+    pos = start
+    for attempt in range(max_retries + 1):
+        req_headers = dict(headers)
+        req_headers['Range'] = f'bytes={pos}-{end}'
+        url = source.resolved
+        try:
+            with _http_get(
+                    url, headers=req_headers, stream=True,
+                    allow_redirects=True, timeout=DOWNLOAD_TIMEOUT) as r:
+                if (r.status_code == 403 and attempt < max_retries and
+                        source.refresh(url)):
+                    continue
+                r.raise_for_status()
+                if r.status_code != 206:
+                    raise IOError(f'Server did not honour the range request for {url}')
+                with open(fn, 'r+b') as f:
+                    f.seek(pos)
+                    for chunk in r.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                        _check_cancelled()
+                        chunk = chunk[:end + 1 - pos]
+                        f.write(chunk)
+                        pos += len(chunk)
+                        _count('bytes', len(chunk))
+                        _progress(len(chunk))
+        except (requests.exceptions.ConnectionError,
+                requests.exceptions.ChunkedEncodingError,
+                requests.exceptions.Timeout) as e:
+            if attempt == max_retries:
+                raise
+            logger.debug(f'Segment {start}-{end} interrupted ({e}), retrying')
+            continue
+        if pos > end:
             return
-    logger.warn(f'Could not find the asset {asset_name}')
+    raise IOError(f'Incomplete download: {source.url}')
+
+def _download_segmented(url, fn, headers=None, connections=None):
+    ''' Downloads a file over several connections, each fetching a byte range
+
+    The ranges are written in place into a preallocated "fn.part" file.
+    Returns the SHA-256 of the file, or None without downloading anything if
+    the server does not support range requests, the file is too small to be
+    worth splitting, or a previous download left a "fn.part" to resume. The
+    hash is computed while the download is running, by reading back each
+    segment once all the previous ones are complete. If a segment fails, the
+    download continues in one stream from the end of the completed segments
+    '''
+    connections = connections or DOWNLOAD_CONNECTIONS
+    part_fn = fn + '.part'
+    if os.path.isfile(part_fn):
+        return None
+    headers = dict(headers or {})
+    probe_headers = dict(headers)
+    probe_headers['Range'] = 'bytes=0-0'
+    with _http_get(
+            url, headers=probe_headers, stream=True,
+            allow_redirects=True, timeout=DOWNLOAD_TIMEOUT) as r:
+        r.raise_for_status()
+        if r.status_code != 206 or 'Content-Range' not in r.headers:
+            return None
+        total = int(r.headers['Content-Range'].rsplit('/', 1)[1])
+        validator = _range_validator(r.headers)
+        source = _RedirectedUrl(url, r.url, headers)
+    if total < SEGMENTED_DOWNLOAD_MIN_SIZE:
+        return None
+    _progress(total=total)
+    if validator is not None:
+        headers['If-Range'] = validator
+
+    with open(part_fn, 'wb') as f:
+        f.truncate(total)
+    segments = [
+        (start, min(start + SEGMENT_SIZE, total) - 1)
+        for start in range(0, total, SEGMENT_SIZE)
+    ]
+    logger.debug(
+        f'Downloading {total} bytes in {len(segments)} segments '
+        f'over {connections} connections')
+    sha256 = hashlib.sha256()
+    n_hashed = 0
+    futures = []
+    try:
+        with concurrent.futures.ThreadPoolExecutor(connections) as executor:
+            futures = [
+                executor.submit(
+                    _in_context(_download_range), source, part_fn, start, end, headers)
+                for start, end in segments
+            ]
+            for future in concurrent.futures.as_completed(futures):
+                if future.exception() is not None:
+                    for f in futures:
+                        f.cancel()
+                    future.result()
+                while (n_hashed < len(segments) and futures[n_hashed].done()
+                       and futures[n_hashed].exception() is None):
+                    start, end = segments[n_hashed]
+                    _hash_file(part_fn, start, end + 1, sha256)
+                    n_hashed += 1
+    except BaseException as e:
+        _keep_completed_segments(part_fn, segments, futures, validator)
+        if not isinstance(e, Exception):
+            raise
+        _check_cancelled()
+        logger.warn(f'Segmented download failed ({e}), continuing in one stream')
+        return _download_stream(url, fn, headers={
+            k: v for k, v in headers.items() if k != 'If-Range'})
+    os.replace(part_fn, fn)
+    return sha256.hexdigest()
+
+def _keep_completed_segments(part_fn, segments, futures, validator):
+    ''' Truncates a failed segmented download to its completed segments at
+    the start of the file, so that _download_stream can resume it '''
+    n_done = 0
+    while (n_done < len(futures) and futures[n_done].done() and
+           not futures[n_done].cancelled() and futures[n_done].exception() is None):
+        n_done += 1
+    size = segments[n_done - 1][1] + 1 if n_done > 0 else 0
+    if size == 0 or validator is None:
+        os.remove(part_fn)
+        return
+    with open(part_fn, 'r+b') as f:
+        f.truncate(size)
+    with open(part_fn + '.validator', 'w') as f:
+        f.write(validator)
+
+def _download_file(url, fn, headers=None):
+    ''' Downloads url to fn, using several connections if possible.
+    Returns the SHA-256 of the file '''
+    if DOWNLOAD_CONNECTIONS > 1:
+        sha256 = _download_segmented(url, fn, headers)
+        if sha256 is not None:
+            return sha256
+    return _download_stream(url, fn, headers)
+
+# Serializes access to the download cache index within this process
+_download_cache_lock = threading.Lock()
+# One lock per cache key, so that concurrent installs download a file once
+_download_key_locks = {}
+
+def _download_cache_index():
+    try:
+        with open(os.path.join(_cache_dir(), 'downloads', 'index.json'), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def _link_or_copy(src, dst):
+    if os.path.isfile(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
 
-def _download_env_docs(version, prefix, pre_release):
-    ''' Looks for a given environment file os SimNIBS in the GitHub Releases
+def _cached_download(key, url, fn, headers=None, sha256=None, size=None):
+    ''' Downloads url to fn through the content-addressed download cache
+
+    Files are stored in the cache by SHA-256, and key (which should change
+    whenever the remote file does) maps to the hash. Cache hits are served by
+    hardlinking or copying. If sha256 is given, the download is verified
+    against it. size, if known, is used to report the progress
     '''
-    avaliable_versions, data = _get_versions(GH_RELEASES_URL, pre_release)
+    if DOWNLOAD_CACHE_SIZE <= 0 or key is None:
+        with _download_progress(os.path.basename(fn), size):
+            digest = _download_file(url, fn, headers)
+        return _verify_download(url, fn, digest, sha256)
+    with _download_cache_lock:
+        key_lock = _download_key_locks.setdefault(key, threading.Lock())
+    with key_lock:
+        objects_dir = os.path.join(_cache_dir(), 'downloads', 'objects')
+        with _download_cache_lock:
+            entry = _download_cache_index().get(key)
+        if entry is not None:
+            obj = os.path.join(objects_dir, entry['sha256'])
+            if os.path.isfile(obj) and os.path.getsize(obj) == entry['size']:
+                logger.info(f'Using cached {os.path.basename(fn)}')
+                _link_or_copy(obj, fn)
+                # Marks it as recently used
+                os.utime(obj, None)
+                return entry['sha256']
+        with _download_progress(os.path.basename(fn), size):
+            digest = _download_file(url, fn, headers)
+        digest = _verify_download(url, fn, digest, sha256)
+        try:
+            _add_to_download_cache(key, fn, digest)
+        except OSError as e:
+            logger.debug(f'Could not add {fn} to the download cache: {e}')
+    return digest
+
+def _verify_download(url, fn, digest, sha256):
+    if sha256 is not None and digest != sha256:
+        os.remove(fn)
+        raise IOError(
+            f'Checksum mismatch for {url}: expected {sha256}, got {digest}')
+    return digest
+
+def _add_to_download_cache(key, fn, sha256):
+    cache_dir = os.path.join(_cache_dir(), 'downloads')
+    objects_dir = os.path.join(cache_dir, 'objects')
+    os.makedirs(objects_dir, exist_ok=True)
+    obj = os.path.join(objects_dir, sha256)
+    if not os.path.isfile(obj):
+        _link_or_copy(fn, obj + '.tmp')
+        os.replace(obj + '.tmp', obj)
+    with _download_cache_lock:
+        index = _download_cache_index()
+        index[key] = {'sha256': sha256, 'size': os.path.getsize(obj)}
+        # Evict the least recently used objects to stay within the budget
+        objects = [
+            (os.stat(os.path.join(objects_dir, o)), o)
+            for o in os.listdir(objects_dir) if not o.endswith('.tmp')
+        ]
+        objects.sort(key=lambda x: x[0].st_mtime)
+        total = sum(st.st_size for st, _ in objects)
+        for st, o in objects:
+            if total <= DOWNLOAD_CACHE_SIZE or o == sha256:
+                continue
+            os.remove(os.path.join(objects_dir, o))
+            total -= st.st_size
+            logger.debug(f'Evicted {o} from the download cache')
+        present = set(os.listdir(objects_dir))
+        index = {k: v for k, v in index.items() if v['sha256'] in present}
+        with open(os.path.join(cache_dir, 'index.json.tmp'), 'w') as f:
+            json.dump(index, f)
+        os.replace(
+            os.path.join(cache_dir, 'index.json.tmp'),
+            os.path.join(cache_dir, 'index.json'))
+
+def _is_url(location):
+    return re.match(r'^https?://', location) is not None
+
+def _mirror_location(*parts):
+    ''' Path or URL of a file in the mirror '''
+    if _is_url(MIRROR):
+        return '/'.join([MIRROR.rstrip('/')] + list(parts))
+    return os.path.abspath(os.path.join(MIRROR, *parts))
+
+def _mirror_url(*parts):
+    ''' Like _mirror_location, but always an URL (file:// for local mirrors) '''
+    location = _mirror_location(*parts)
+    if _is_url(location):
+        return location
+    return pathlib.Path(location).as_uri()
+
+def _fetch_from_mirror(parts, fn):
+    ''' Copies or downloads a file from the mirror '''
+    location = _mirror_location(*parts)
+    logger.debug(f'Fetching {location}')
+    if _is_url(location):
+        with _download_progress(os.path.basename(fn)):
+            _download_file(location, fn)
+    else:
+        shutil.copyfile(location, fn)
+
+def _read_mirror_json(*parts):
+    location = _mirror_location(*parts)
+    if _is_url(location):
+        r = _http_get(location, timeout=DOWNLOAD_TIMEOUT)
+        r.raise_for_status()
+        return r.json()
+    with open(location, 'r') as f:
+        return json.load(f)
+
+def _download_asset(catalogue, version, asset_name, fn):
+    ''' Downloads an asset of a version in the catalogue to fn '''
+    url = catalogue.url
+    if MIRROR is not None and url == GH_RELEASES_URL:
+        tag = catalogue.release(version)['tag_name']
+        _fetch_from_mirror(('assets', tag, asset_name), fn)
+        return
+    asset = catalogue.asset(version, asset_name)
+    if asset is None:
+        logger.warn(f'Could not find the asset {asset_name}')
+        return
+    sha256 = None
+    if (asset.get('digest') or '').startswith('sha256:'):
+        sha256 = asset['digest'][len('sha256:'):]
+    return _cached_download(
+        f'{url}/assets/{asset["id"]}@{asset["updated_at"]}',
+        f'{url}/assets/{asset["id"]}', fn,
+        headers={'Accept': 'application/octet-stream'},
+        sha256=sha256, size=asset.get('size'))
+
+def _asset_fingerprint(version, pre_release, asset_name):
+    ''' Identifies the current contents of a release asset '''
+    _get_release(version, pre_release)
+    asset = _get_catalogue(GH_RELEASES_URL, pre_release).asset(version, asset_name)
+    if asset is None:
+        return None
+    return [asset.get('id'), asset.get('updated_at'), asset.get('digest')]
+
+def _file_sha256(fn):
+    if not os.path.isfile(fn):
+        return None
+    return _hash_file(fn).hexdigest()
+
+def _get_release(version, pre_release):
+    ''' Release data of a given SimNIBS version '''
+    catalogue = _get_catalogue(GH_RELEASES_URL, pre_release)
     try:
-        release_data = data[avaliable_versions[version]]
+        return catalogue.release(version)
     except KeyError:
-        ver_string = '\n'.join(avaliable_versions.keys())
+        ver_string = '\n'.join(catalogue.versions())
         raise ValueError(
             f'\nCould not find SimNIBS version: {version}\n'
             f'Avaliable versions are:\n{ver_string}')
 
-    # Download the environment file
+def _download_env_file(version, prefix, pre_release):
+    ''' Downloads the environment file of a given version of SimNIBS from
+    the GitHub Releases. Returns the URL pip gets SimNIBS from
+    '''
+    release_data = _get_release(version, pre_release)
     env_file = _env_file()
     logger.info(f"Version: {release_data['tag_name'][1:]}")
     logger.info("Downloading the environment file")
-    _download_asset(GH_RELEASES_URL, release_data, env_file, os.path.join(prefix, env_file))
+    _download_asset(
+        _get_catalogue(GH_RELEASES_URL, pre_release), version, env_file,
+        os.path.join(prefix, env_file))
     logger.info('Finished downloading the environment file')
+    if MIRROR is not None:
+        return _mirror_location('assets', release_data['tag_name'])
+    return release_data['html_url']
+
+def _download_docs(version, prefix, pre_release):
+    ''' Downloads and extracts the documentation of a given version '''
+    _get_release(version, pre_release)
     logger.info("Downloading the documentation")
     _download_asset(
-        GH_RELEASES_URL, release_data, 'documentation.zip', os.path.join(prefix, 'documentation.zip'))
+        _get_catalogue(GH_RELEASES_URL, pre_release), version,
+        'documentation.zip', os.path.join(prefix, 'documentation.zip'))
     logger.info('Finished downloading the documentation')
     logger.info('Extracting the documentation')
-    if os.path.isdir(os.path.join(prefix, 'documentation')):
-        shutil.rmtree(os.path.join(prefix, 'documentation'))
-    with zipfile.ZipFile(os.path.join(prefix, 'documentation.zip')) as z:
-        z.extractall(os.path.join(prefix, 'documentation'))
+    with _phase('docs_extract'):
+        _sync_documentation(
+            os.path.join(prefix, 'documentation.zip'),
+            os.path.join(prefix, 'documentation'))
     os.remove(os.path.join(prefix, 'documentation.zip'))
-    return release_data['html_url']
+
+def _docs_mode(prefix):
+    ''' Documentation mode for an install of prefix (see DOCS) '''
+    if DOCS is not None:
+        return DOCS
+    return _read_state(prefix).get('docs', {}).get('mode', 'full')
+
+def _install_docs(version, prefix, pre_release, mode):
+    ''' Installs the documentation, or a stub page pointing to --fetch-docs '''
+    docs_dir = os.path.join(prefix, 'documentation')
+    if mode == 'full':
+        _download_docs(version, prefix, pre_release)
+    else:
+        if os.path.isdir(docs_dir):
+            shutil.rmtree(docs_dir)
+        if mode == 'lazy':
+            _write_docs_stub(docs_dir, version, prefix)
+            logger.info(
+                'Skipping the documentation download, '
+                'run "update_simnibs --fetch-docs" to get it')
+        else:
+            logger.info('Skipping the documentation')
+    with _edit_state(prefix) as state:
+        state['docs'] = {'mode': mode, 'version': version}
+
+def _write_docs_stub(docs_dir, version, prefix):
+    ''' Writes a documentation/index.html explaining how to get the docs '''
+    update_exe = os.path.join(
+        prefix, 'bin', 'update_simnibs' + os.path.splitext(FILENAME)[1])
+    os.makedirs(docs_dir, exist_ok=True)
+    with open(os.path.join(docs_dir, 'index.html'), 'w') as f:
+        f.write(
+            '<!DOCTYPE html>\n<html><head><meta charset="utf-8">'
+            f'<title>SimNIBS {version} documentation</title></head><body>\n'
+            f'<h1>SimNIBS {version} documentation</h1>\n'
+            '<p>The documentation was not installed with SimNIBS. To download '
+            'it, run</p>\n'
+            f'<pre>"{update_exe}" --fetch-docs</pre>\n'
+            f'<p>or read it online at <a href="{DOCS_URL}">{DOCS_URL}</a>.</p>\n'
+            '</body></html>\n')
+
+def fetch_docs(prefix):
+    ''' Downloads the documentation of an install done with --docs lazy or none '''
+    prefix = os.path.abspath(prefix)
+    version = _read_state(prefix).get('docs', {}).get('version')
+    if version is None and os.path.isfile(_simnibs_exe(prefix)):
+        version = _get_current_version(prefix)
+    if _parse_version(version) is None:
+        raise OSError(f'Could not find the SimNIBS version installed in {prefix}')
+    _download_docs(version, prefix, True)
+    # Later updates keep the documentation up to date
+    with _edit_state(prefix) as state:
+        state['docs'] = {'mode': 'full', 'version': version}
+    logger.info(
+        'Documentation installed in ' + os.path.join(prefix, 'documentation'))
+
+def _file_matches(path, info, manifest):
+    ''' Checks if the file in path has the same contents as the zip entry
+
+    manifest has the CRC and mtime of the files written in the last sync, so
+    for files not touched since then we don't need to read them back '''
+    try:
+        st = os.stat(path)
+    except OSError:
+        return False
+    if st.st_size != info.file_size:
+        return False
+    if manifest.get(info.filename) == [info.CRC, int(st.st_mtime)]:
+        return True
+    crc = 0
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b''):
+            crc = zlib.crc32(block, crc)
+    return crc == info.CRC
+
+def _sync_documentation(zip_fn, target_dir):
+    ''' Makes target_dir match the contents of zip_fn
+
+    Only entries which differ from the files on disk are extracted, and files
+    not in the archive are removed '''
+    target_dir = os.path.abspath(target_dir)
+    manifest_fn = os.path.join(target_dir, '.manifest.json')
+    try:
+        with open(manifest_fn, 'r') as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        manifest = {}
+    new_manifest = {}
+    expected = set([manifest_fn])
+    n_written = 0
+    n_removed = 0
+    with zipfile.ZipFile(zip_fn) as z:
+        for info in z.infolist():
+            path = os.path.normpath(os.path.join(target_dir, info.filename))
+            if not path.startswith(target_dir + os.sep):
+                logger.warn(f'Ignoring documentation entry {info.filename}')
+                continue
+            expected.add(path)
+            if info.filename.endswith('/'):
+                os.makedirs(path, exist_ok=True)
+                continue
+            if not _file_matches(path, info, manifest):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with z.open(info) as src, open(path, 'wb') as dst:
+                    shutil.copyfileobj(src, dst, DOWNLOAD_CHUNK_SIZE)
+                n_written += 1
+            new_manifest[info.filename] = [info.CRC, int(os.stat(path).st_mtime)]
+
+    for root, dirs, files in os.walk(target_dir, topdown=False):
+        for name in files:
+            path = os.path.join(root, name)
+            if path not in expected:
+                os.remove(path)
+                n_removed += 1
+        for name in dirs:
+            path = os.path.join(root, name)
+            if path not in expected and not os.listdir(path):
+                os.rmdir(path)
+    with open(manifest_fn, 'w') as f:
+        json.dump(new_manifest, f)
+    logger.info(
+        f'Documentation: {n_written} files updated, {n_removed} files removed, '
+        f'{len(new_manifest) - n_written} files unchanged')
 
 def _env_file():
     if sys.platform == 'win32':
@@ -241,108 +1526,818 @@ def _env_file():
     else:
         raise OSError('OS not supported')
 
-def _download_and_install_miniconda(miniconda_dir):
-    # Download Miniconda installer
+def _miniconda_installer_name():
     if sys.platform == 'linux':
-        url = "https://repo.continuum.io/miniconda/Miniconda3-latest-Linux-x86_64.sh"
+        return 'Miniconda3-latest-Linux-x86_64.sh'
     elif sys.platform == 'darwin':
-        url = "https://repo.continuum.io/miniconda/Miniconda3-latest-MacOSX-x86_64.sh"
+        return 'Miniconda3-latest-MacOSX-x86_64.sh'
     elif sys.platform == 'win32':
-        url = "https://repo.continuum.io/miniconda/Miniconda3-latest-Windows-x86_64.exe"
+        return 'Miniconda3-latest-Windows-x86_64.exe'
     else:
         raise OSError('OS not supported')
+
+def _download_miniconda(fn):
+    ''' Downloads the Miniconda installer to fn '''
     logger.info('Downloading the Miniconda installer')
-    r = requests.get(url, allow_redirects=True)
-    r.raise_for_status()
+    if MIRROR is not None:
+        _fetch_from_mirror(('miniconda', _miniconda_installer_name()), fn)
+    else:
+        url = f'{MINICONDA_URL}/{_miniconda_installer_name()}'
+        # "latest" changes over time, so the cache key includes the ETag
+        r = _http_request('HEAD', url, allow_redirects=True, timeout=DOWNLOAD_TIMEOUT)
+        r.raise_for_status()
+        validator = r.headers.get('ETag') or r.headers.get('Last-Modified')
+        key = None if validator is None else f'{url}@{validator}'
+        _cached_download(key, url, fn)
+    logger.info('Finished downloading the Miniconda installer')
+
+def _install_miniconda(miniconda_installer_path, miniconda_dir):
+    ''' Runs the Miniconda installer '''
+    logger.info('Installing Miniconda, this might take some time')
     if sys.platform == 'win32':
-        miniconda_installer_path = os.path.abspath(
-            os.path.join(miniconda_dir, '..', 'miniconda_installer.exe'))
-        with open(miniconda_installer_path, 'wb') as f:
-            f.write(r.content)
-        logger.info('Finished downloading the Miniconda installer')
-        logger.info('Installing Miniconda, this might take some time')
         run_command(
             f'"{miniconda_installer_path}" /InstallationType=JustMe '
             f'/RegisterPython=0 /AddToPath=0 /S /D={miniconda_dir}')
         # The /D argument should NOT be wrapped in ""
-        logger.info('Finished installing Minicoda')
-        os.remove(miniconda_installer_path)
     else:
-        miniconda_installer_path = os.path.abspath(
-            os.path.join(miniconda_dir, '..', 'miniconda_installer.sh'))
-        with open(miniconda_installer_path, 'wb') as f:
-            f.write(r.content)
-        logger.info('Finished downloading the Miniconda installer')
-        # Run the instaler
         run_command(
             f'bash "{miniconda_installer_path}" '
             f'-b -f -p "{miniconda_dir}"')
-        logger.info('Finished installing Minicoda')
-        os.remove(miniconda_installer_path)
+    logger.info('Finished installing Minicoda')
 
-def _install_env_and_simnibs(version_url, conda_executable, prefix):
-    ''' Install the environment and SimNIBS
+def _download_and_install_miniconda(miniconda_dir):
+    miniconda_installer_path = os.path.abspath(
+        os.path.join(
+            miniconda_dir, '..',
+            'miniconda_installer' + os.path.splitext(_miniconda_installer_name())[1]))
+    with _phase('miniconda_download'):
+        _download_miniconda(miniconda_installer_path)
+    with _phase('miniconda_install'):
+        _install_miniconda(miniconda_installer_path, miniconda_dir)
+    os.remove(miniconda_installer_path)
+
+def _read_env_file(fn):
+    ''' Minimal parser for conda environment files
+
+    Returns
+    --------
+    channels: list
+        Channels in the file
+    dependencies: list
+        conda package specs
+    pip_dependencies: list
+        pip package specs
     '''
-    logger.info('Installing the environment and SimNIBS')
-    logger.debug(f'Download URL: {version_url}')
-    logger.debug(f'Conda executable: {conda_executable}')
-    activate_executable = os.path.join(os.path.dirname(conda_executable), 'activate')
-    env_file = os.path.join(prefix, _env_file())
-    if sys.platform == 'win32':
-        run_command(
-            f'call "{activate_executable}" && '
-            f'conda update -y conda && '
-            f'conda env update -f "{env_file}" && '
-            f'conda clean -y -a -q'
-        )
-        run_command(
-            f'call "{activate_executable}" simnibs_env && '
-            f'pip install --no-cache-dir --upgrade -f {version_url} simnibs'
-        )
+    channels = []
+    dependencies = []
+    pip_dependencies = []
+    section = None
+    in_pip = False
+    pip_indent = 0
+    with open(fn, 'r') as f:
+        for line in f:
+            line = line.split('#', 1)[0].rstrip()
+            if line.strip() == '':
+                continue
+            indent = len(line) - len(line.lstrip())
+            item = line.strip()
+            if indent == 0:
+                section = item.rstrip(':')
+                in_pip = False
+                continue
+            if not item.startswith('- '):
+                continue
+            item = item[2:].strip().strip('\'"')
+            if in_pip and indent > pip_indent:
+                pip_dependencies.append(item)
+                continue
+            in_pip = False
+            if section == 'channels':
+                channels.append(item)
+            elif section == 'dependencies':
+                if item == 'pip:':
+                    in_pip = True
+                    pip_indent = indent
+                else:
+                    dependencies.append(item)
+    return channels, dependencies, pip_dependencies
+
+def _mirror_env_file(env_file, fn):
+    ''' Writes a copy of env_file which only uses the channel in the mirror '''
+    with open(env_file, 'r') as f:
+        lines = f.readlines()
+    out = []
+    skip = False
+    for line in lines:
+        if skip and (line.startswith((' ', '\t', '-')) or line.strip() == ''):
+            continue
+        skip = False
+        if line.startswith('channels:'):
+            out.append('channels:\n')
+            out.append(f'  - {_mirror_url("channel")}\n')
+            out.append('  - nodefaults\n')
+            skip = True
+        else:
+            out.append(line)
+    with open(fn, 'w') as f:
+        f.writelines(out)
+
+def _child_env(**extra):
+    ''' Environment for child processes, with extra variables set '''
+    env = dict(ENV if ENV is not None else os.environ)
+    env.update(extra)
+    return env
+
+def _download_micromamba(fn):
+    ''' Downloads the standalone micromamba executable to fn '''
+    if sys.platform == 'linux':
+        platform = 'linux-64'
+        member = 'bin/micromamba'
+    elif sys.platform == 'darwin':
+        platform = 'osx-arm64' if os.uname().machine == 'arm64' else 'osx-64'
+        member = 'bin/micromamba'
+    elif sys.platform == 'win32':
+        platform = 'win-64'
+        member = 'Library/bin/micromamba.exe'
     else:
+        raise OSError('OS not supported')
+    logger.info('Downloading micromamba')
+    with tempfile.TemporaryDirectory() as tmpdir:
+        archive = os.path.join(tmpdir, 'micromamba.tar.bz2')
+        _download_file(f'{MICROMAMBA_URL}/{platform}/latest', archive)
+        os.makedirs(os.path.dirname(fn), exist_ok=True)
+        with tarfile.open(archive, 'r:bz2') as t, open(fn, 'wb') as f:
+            shutil.copyfileobj(t.extractfile(member), f)
+    os.chmod(fn, os.stat(fn).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+
+
+class CondaBackend:
+    ''' Solves and installs the environment with one of the SOLVERS
+
+    conda: conda with its default solver, updating conda first so that old
+        Miniconda installs can handle new environment files
+    libmamba: conda with the libmamba solver
+    mamba: mamba, installed in the base environment if needed
+    micromamba: the standalone micromamba executable, with the Miniconda
+        install as root prefix
+
+    Parameters
+    ------------
+    conda_executable: str
+        conda executable of the base install, or a micromamba executable
+    solver: str
+        One of SOLVERS, or 'auto' to pick the fastest one already avaliable
+    env_dir: str
+        Where to create simnibs_env. Default: the envs folder of the base
+        install
+    external: bool
+        Whether the base install is shared with other software (see --conda).
+        If so, it is never modified: the solver needs to be avaliable already,
+        and conda is not updated or cleaned. When installing from a mirror,
+        solvers which are not avaliable are not installed either
+    '''
+    def __init__(self, conda_executable, solver='auto', env_dir=None, external=False):
+        self.conda_executable = conda_executable
+        self.external = external
+        if _is_micromamba(conda_executable):
+            self.base_dir = os.environ.get(
+                'MAMBA_ROOT_PREFIX', os.path.join(os.path.expanduser('~'), 'micromamba'))
+            self.micromamba_executable = conda_executable
+            solver = 'micromamba'
+        else:
+            self.base_dir = os.path.abspath(
+                os.path.join(os.path.dirname(conda_executable), '..'))
+            self.micromamba_executable = self._base_executable('micromamba')
+        if solver == 'auto':
+            solver = self._detect()
+        elif solver not in SOLVERS:
+            raise ValueError(f'Unknown solver: {solver}')
+        elif external and not self._has_solver(solver):
+            logger.warn(
+                f'The {solver} solver is not avaliable in {self.base_dir}, '
+                'which will not be modified')
+            solver = self._detect()
+        elif MIRROR is not None and not self._has_solver(solver):
+            # Installing it would need the network
+            logger.warn(
+                f'The {solver} solver is not avaliable in {self.base_dir}, '
+                'and can not be installed from the mirror')
+            solver = self._detect()
+        self.solver = solver
+        self.env_dir = env_dir or os.path.join(self.base_dir, 'envs', 'simnibs_env')
+
+    def _base_executable(self, name):
+        if sys.platform == 'win32':
+            if name == 'micromamba':
+                return os.path.join(self.base_dir, 'Library', 'bin', name + '.exe')
+            elif name == 'python':
+                return os.path.join(self.base_dir, name + '.exe')
+            return os.path.join(self.base_dir, 'Scripts', name + '.exe')
+        return os.path.join(self.base_dir, 'bin', name)
+
+    def _has_libmamba(self):
+        return subprocess.call(
+            [self._base_executable('python'), '-c', 'import conda_libmamba_solver'],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+            stdin=subprocess.DEVNULL, env=ENV) == 0
+
+    def _has_solver(self, solver):
+        if solver == 'conda':
+            return True
+        elif solver == 'libmamba':
+            return os.path.isfile(self._base_executable('python')) and self._has_libmamba()
+        elif solver == 'mamba':
+            return os.path.isfile(self._base_executable('mamba'))
+        elif solver == 'micromamba':
+            return os.path.isfile(self.micromamba_executable)
+
+    def _detect(self):
+        if self._has_solver('mamba'):
+            return 'mamba'
+        if self._has_solver('libmamba'):
+            return 'libmamba'
+        return 'conda'
+
+    def _in_base(self, command):
+        ''' Wraps command so that it runs with the base environment active '''
+        activate_executable = os.path.join(
+            os.path.dirname(self.conda_executable), 'activate')
+        if sys.platform == 'win32':
+            return f'call "{activate_executable}" && {command}'
         # I use "." instead of source as it is executed in an sh shell
-        run_command(
-            f'. "{activate_executable}" && '
-            f'conda update -y conda && '
-            f'conda env update -f "{env_file}" && '
-            f'conda clean -y -a -q'
-        )
-        pip_executable = os.path.join(
-            os.path.dirname(conda_executable),
-            '..', 'envs', 'simnibs_env', 'bin', 'pip')
-        run_command(
-            f'"{pip_executable}" install --no-cache-dir --upgrade -f {version_url} simnibs'
-        )
+        return f'. "{activate_executable}" && {command}'
+
+    def in_env(self, executable, args):
+        ''' Command running an executable of simnibs_env '''
+        if sys.platform != 'win32':
+            return f'"{os.path.join(self.env_dir, "bin", executable)}" {args}'
+        if _is_micromamba(self.conda_executable):
+            return f'"{self.conda_executable}" run -p "{self.env_dir}" {executable} {args}'
+        activate_executable = os.path.join(
+            os.path.dirname(self.conda_executable), 'activate')
+        return f'call "{activate_executable}" "{self.env_dir}" && {executable} {args}'
+
+    def prepare(self):
+        ''' Installs or updates what the solver needs '''
+        logger.info(f'Using the {self.solver} solver')
+        if self.external:
+            return
+        if self.solver == 'conda':
+            # The mirror has no conda updates
+            if MIRROR is None:
+                run_command(self._in_base('conda update -y conda'))
+        elif self.solver == 'libmamba':
+            if not self._has_libmamba():
+                run_command(self._in_base(
+                    'conda install -y -n base conda-libmamba-solver'))
+        elif self.solver == 'mamba':
+            if not os.path.isfile(self._base_executable('mamba')):
+                run_command(self._in_base(
+                    'conda install -y -n base -c conda-forge mamba'))
+        elif self.solver == 'micromamba':
+            if not os.path.isfile(self.micromamba_executable):
+                _download_micromamba(self.micromamba_executable)
+
+    def update_env(self, env_file, prune=False, **extra_env):
+        ''' Creates or updates simnibs_env from env_file. With prune, packages
+        not required by env_file are removed '''
+        prune_arg = ' --prune' if prune else ''
+        if self.solver == 'conda':
+            command = self._in_base(
+                f'conda env update -p "{self.env_dir}" -f "{env_file}"{prune_arg}')
+        elif self.solver == 'libmamba':
+            extra_env['CONDA_SOLVER'] = 'libmamba'
+            command = self._in_base(
+                f'conda env update -p "{self.env_dir}" -f "{env_file}"{prune_arg}')
+        elif self.solver == 'mamba':
+            command = self._in_base(
+                f'mamba env update -p "{self.env_dir}" -f "{env_file}"{prune_arg}')
+        elif self.solver == 'micromamba':
+            if prune and os.path.isdir(self.env_dir):
+                # micromamba install can't prune, so start from scratch
+                shutil.rmtree(self.env_dir)
+            if os.path.isdir(self.env_dir):
+                action = 'install'
+            else:
+                action = 'create'
+            command = (
+                f'"{self.micromamba_executable}" {action} -y '
+                f'-r "{self.base_dir}" -p "{self.env_dir}" -f "{env_file}"')
+        run_command(command, env=_child_env(**extra_env) if extra_env else None)
+
+    def install_packages(self, specs, channels, **extra_env):
+        ''' Installs the given package specs into simnibs_env '''
+        specs = ' '.join(f'"{spec}"' for spec in specs)
+        channels = ' '.join(f'-c "{c}"' for c in channels if c != 'nodefaults')
+        if self.solver == 'micromamba':
+            command = (
+                f'"{self.micromamba_executable}" install -y '
+                f'-r "{self.base_dir}" -p "{self.env_dir}" '
+                f'--override-channels {channels} {specs}')
+        else:
+            if self.solver == 'libmamba':
+                extra_env['CONDA_SOLVER'] = 'libmamba'
+            tool = 'mamba' if self.solver == 'mamba' else 'conda'
+            command = self._in_base(
+                f'{tool} install -y -p "{self.env_dir}" '
+                f'--override-channels {channels} {specs}')
+        run_command(command, env=_child_env(**extra_env) if extra_env else None)
+
+    def list_packages(self):
+        ''' Packages in simnibs_env, as a dictionary name: "version=build" '''
+        try:
+            res = subprocess.check_output(
+                [self.conda_executable, 'list', '-p', self.env_dir, '--json'],
+                stderr=subprocess.DEVNULL, stdin=subprocess.DEVNULL,
+                env=ENV, universal_newlines=True)
+            packages = json.loads(res)
+        except (OSError, subprocess.CalledProcessError, ValueError):
+            return None
+        if not isinstance(packages, list):
+            return None
+        return {
+            p['name']: f"{p['version']}={p.get('build_string', '')}"
+            for p in packages
+        }
+
+    def clean(self):
+        ''' Prunes the package cache, keeping the packages in use '''
+        # Other environments might be using the caches of a shared install
+        if self.external:
+            return
+        # Concurrent installs share the cache, run_fleet prunes it at the end
+        if PKGS_SHARED:
+            return
+        _prune_pkgs(self.pkgs_dir(), _conda_envs(self.base_dir) + [self.env_dir])
 
+    def pkgs_dir(self):
+        ''' Package cache conda downloads to: the first of its pkgs_dirs '''
+        try:
+            res = subprocess.check_output(
+                [self.conda_executable, 'info', '--json'],
+                stderr=subprocess.DEVNULL, stdin=subprocess.DEVNULL,
+                env=ENV, universal_newlines=True)
+            info = json.loads(res)
+            # micromamba calls it "package cache"
+            pkgs_dirs = info.get('pkgs_dirs') or info.get('package cache')
+            if pkgs_dirs:
+                return pkgs_dirs[0]
+        except (OSError, subprocess.CalledProcessError, ValueError, AttributeError):
+            pass
+        pkgs_dirs = (ENV if ENV is not None else os.environ).get('CONDA_PKGS_DIRS')
+        if pkgs_dirs:
+            return pkgs_dirs.split(',')[0]
+        return os.path.join(self.base_dir, 'pkgs')
+
+
+def _conda_envs(base_dir):
+    ''' The base environment of a conda install, and the ones in envs/ '''
+    envs_dir = os.path.join(base_dir, 'envs')
+    if not os.path.isdir(envs_dir):
+        return [base_dir]
+    return [base_dir] + [os.path.join(envs_dir, d) for d in os.listdir(envs_dir)]
+
+def _dir_size(path):
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            try:
+                size += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return size
+
+def _prune_pkgs(pkgs_dir, env_dirs):
+    ''' Evicts the least recently used packages from a conda package cache
+
+    Packages installed in env_dirs, or in the environments conda has
+    registered for this user, are kept and marked as used. The others are
+    removed, oldest first, until they take at most PKGS_CACHE_SIZE, so that
+    unchanged packages don't need to be downloaded again by updates '''
+    if not os.path.isdir(pkgs_dir):
+        return
+    env_dirs = list(env_dirs)
+    try:
+        with open(os.path.join(os.path.expanduser('~'), '.conda', 'environments.txt')) as f:
+            env_dirs += [line.strip() for line in f if line.strip()]
+    except OSError:
+        pass
+    in_use = set()
+    for env_dir in env_dirs:
+        meta_dir = os.path.join(env_dir, 'conda-meta')
+        if os.path.isdir(meta_dir):
+            in_use.update(
+                fn[:-len('.json')] for fn in os.listdir(meta_dir)
+                if fn.endswith('.json'))
+    # A package can be extracted, as a tarball, or both
+    packages = collections.defaultdict(list)
+    for name in os.listdir(pkgs_dir):
+        path = os.path.join(pkgs_dir, name)
+        for ext in ['.tar.bz2', '.conda']:
+            if name.endswith(ext) and os.path.isfile(path):
+                packages[name[:-len(ext)]].append(path)
+        if os.path.isfile(os.path.join(path, 'info', 'index.json')):
+            packages[name].append(path)
+
+    unused = []
+    for dist, paths in packages.items():
+        if dist in in_use:
+            for path in paths:
+                os.utime(path, None)
+            continue
+        size = sum(
+            _dir_size(path) if os.path.isdir(path) else os.path.getsize(path)
+            for path in paths)
+        last_used = max(os.path.getmtime(path) for path in paths)
+        unused.append((last_used, dist, paths, size))
+    unused.sort()
+    total = sum(u[3] for u in unused)
+    n_removed = 0
+    reclaimed = 0
+    for _, dist, paths, size in unused:
+        if total <= PKGS_CACHE_SIZE:
+            break
+        for path in paths:
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                os.remove(path)
+        logger.debug(f'Evicted {dist} from the package cache')
+        total -= size
+        reclaimed += size
+        n_removed += 1
+    logger.info(
+        f'Package cache: removed {n_removed} unused packages, reclaimed '
+        f'{_format_size(reclaimed)}, kept {len(packages) - n_removed} packages')
+
+def _is_micromamba(executable):
+    return os.path.basename(executable).lower().startswith('micromamba')
+
+def _find_conda(location):
+    ''' Finds the conda, mamba or micromamba executable given to --conda
+
+    location can be an executable, the directory of a conda install, or
+    'auto' to look for the one active in this shell or in the PATH '''
+    if location == 'auto':
+        candidates = [os.environ.get('CONDA_EXE'), os.environ.get('MAMBA_EXE')]
+        candidates += [shutil.which(name) for name in ['conda', 'micromamba']]
+        candidates = [c for c in candidates if c]
+        if not candidates:
+            raise OSError('Could not find a conda, mamba or micromamba install')
+        location = candidates[0]
+    location = os.path.abspath(os.path.expanduser(location))
+    if os.path.isdir(location):
+        executable = os.path.join(
+            location, 'Scripts' if sys.platform == 'win32' else 'bin',
+            'conda.exe' if sys.platform == 'win32' else 'conda')
+    else:
+        executable = location
+        name = os.path.splitext(os.path.basename(executable))[0].lower()
+        # The condabin folder and mamba only have wrappers, we want the
+        # conda executable next to the activate script
+        parent = os.path.dirname(executable)
+        if os.path.basename(parent) == 'condabin' or name == 'mamba':
+            base_dir = os.path.dirname(parent)
+            executable = os.path.join(
+                base_dir, 'Scripts' if sys.platform == 'win32' else 'bin',
+                'conda.exe' if sys.platform == 'win32' else 'conda')
+    if not os.path.isfile(executable):
+        raise OSError(f'Could not find a conda or micromamba executable in {location}')
+    return executable
+
+
+def _read_state(prefix):
+    ''' Reads what previous runs of the installer recorded about prefix '''
+    try:
+        with open(os.path.join(prefix, 'simnibs_installer_state.json'), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def _write_state(prefix, state):
+    fn = os.path.join(prefix, 'simnibs_installer_state.json')
+    with open(fn + '.tmp', 'w') as f:
+        json.dump(state, f, indent=2)
+    os.replace(fn + '.tmp', fn)
+
+# Install phases running in parallel update the state file
+_state_lock = threading.RLock()
+
+@contextlib.contextmanager
+def _edit_state(prefix):
+    ''' Reads the state of prefix, and writes it back after the changes '''
+    with _state_lock:
+        state = _read_state(prefix)
+        yield state
+        _write_state(prefix, state)
+
+
+class Checkpoint:
+    ''' Phases of an install completed so far, to resume it if it fails
+
+    Stored in the state file, with the inputs of each phase (versions, asset
+    and file hashes) so that a phase is only skipped if it would do the same
+    thing again. It is removed once the install finishes
+
+    Parameters
+    ------------
+    prefix: str
+        Install directory
+    version: str
+        SimNIBS version being installed. Checkpoints of other versions are
+        discarded
+    '''
+    def __init__(self, prefix, version):
+        self.prefix = prefix
+        self.version = version
+        with _edit_state(prefix) as state:
+            checkpoint = state.get('checkpoint')
+            if checkpoint is None or checkpoint['version'] != version:
+                state['checkpoint'] = {'version': version, 'phases': {}}
+            elif checkpoint['phases']:
+                logger.info(
+                    'Resuming the install, completed phases: '
+                    + ', '.join(checkpoint['phases']))
+
+    def get(self, name, inputs):
+        ''' Returns (True, result) if the phase is done with these inputs,
+        (False, None) otherwise '''
+        with _state_lock:
+            entry = _read_state(self.prefix).get(
+                'checkpoint', {}).get('phases', {}).get(name)
+        if entry is None or entry['inputs'] != inputs:
+            return False, None
+        return True, entry['result']
+
+    def save(self, name, inputs, result):
+        with _edit_state(self.prefix) as state:
+            state['checkpoint']['phases'][name] = {'inputs': inputs, 'result': result}
+
+    def finish(self):
+        with _edit_state(self.prefix) as state:
+            state.pop('checkpoint', None)
+
+def _spec_name(spec):
+    ''' Package name in a conda package spec, e.g. "conda-forge::numpy>=1.2" '''
+    return re.split(r'[\s=<>!~\[]', spec.split('::')[-1], 1)[0].lower()
+
+def _env_fingerprint(env_file, packages):
+    ''' What we need to know to skip an environment update later '''
+    channels, dependencies, pip_dependencies = _read_env_file(env_file)
+    # SimNIBS itself is installed afterwards with pip
+    packages = {k: v for k, v in (packages or {}).items() if k != 'simnibs'}
+    return {
+        'env_file_sha256': _hash_file(env_file).hexdigest(),
+        'channels': channels,
+        'dependencies': dependencies,
+        'pip_dependencies': pip_dependencies,
+        'packages': packages
+    }
+
+def _update_env(backend, env_file, prefix, **extra_env):
+    ''' Brings simnibs_env in line with env_file, doing as little as possible
+
+    Compares env_file and the packages in the environment against the
+    fingerprint stored by the previous install. If nothing changed, nothing
+    is done. If only conda dependencies changed, only they are installed.
+    Otherwise, the full environment is updated, removing the packages no
+    longer in env_file if some were
+    '''
+    state = _read_state(prefix)
+    previous = state.get('environment')
+    current = _env_fingerprint(env_file, None)
+    prune = False
+    if previous is not None and os.path.isdir(backend.env_dir):
+        installed = backend.list_packages()
+        if installed is None:
+            logger.debug('Could not list the packages in simnibs_env')
+        elif {k: v for k, v in installed.items() if k != 'simnibs'} != previous['packages']:
+            logger.info('simnibs_env was modified since the last install')
+        elif current['env_file_sha256'] == previous['env_file_sha256']:
+            logger.info('simnibs_env is up to date, skipping the environment update')
+            return
+        elif (current['channels'] == previous['channels'] and
+              current['pip_dependencies'] == previous['pip_dependencies']):
+            changed = [
+                d for d in current['dependencies']
+                if d not in previous['dependencies']]
+            current_names = set(_spec_name(d) for d in current['dependencies'])
+            removed = [
+                d for d in previous['dependencies']
+                if _spec_name(d) not in current_names]
+            if removed:
+                # Installing packages can't remove the old ones
+                logger.info(
+                    'Packages were removed from the environment file ('
+                    + ', '.join(removed) + '), updating the full environment')
+                prune = True
+            elif not changed:
+                logger.info('The conda dependencies did not change, skipping the environment update')
+                return
+            else:
+                logger.info(
+                    'Updating only the changed packages in simnibs_env: '
+                    + ', '.join(changed))
+                try:
+                    backend.install_packages(changed, current['channels'], **extra_env)
+                except OSError:
+                    logger.info('Could not update the packages, updating the full environment')
+                else:
+                    return
+    backend.prepare()
+    backend.update_env(env_file, prune=prune, **extra_env)
+    backend.clean()
+
+def _record_env(backend, env_file, prefix):
+    ''' Stores the fingerprint of the environment, for _update_env '''
+    packages = backend.list_packages()
+    if packages is None:
+        return
+    with _edit_state(prefix) as state:
+        state['environment'] = _env_fingerprint(env_file, packages)
+
+
+def _prefetch_wheels(version, pre_release):
+    ''' Downloads the SimNIBS wheels for this platform from the release
+    assets into the wheelhouse. Returns the wheelhouse directory, or None if
+    the release has no wheels for this platform or they could not be
+    downloaded
 
-def _run_postinstall(conda_executable, prefix, silent):
+    Runs in parallel with the conda install of the environment '''
+    # Progress lines would get in the way of the conda output
+    _context.on_progress = None
+    try:
+        release_data = _get_release(version, pre_release)
+        catalogue = _get_catalogue(GH_RELEASES_URL, pre_release)
+        wheels = [
+            name for name in catalogue.asset_names(version)
+            if name.startswith('simnibs-') and _is_platform_wheel(name)]
+        if not wheels:
+            return None
+        wheelhouse = os.path.join(_cache_dir(), 'wheelhouse', release_data['tag_name'])
+        with _wheelhouse_lock:
+            os.makedirs(wheelhouse, exist_ok=True)
+            # Marks it as used by this run before anything can prune it
+            os.utime(wheelhouse, None)
+        for name in wheels:
+            fn = os.path.join(wheelhouse, name)
+            if os.path.isfile(fn + '.complete'):
+                continue
+            logger.debug(f'Prefetching {name}')
+            _download_asset(catalogue, version, name, fn)
+            open(fn + '.complete', 'w').close()
+        # Marks it as recently used, and removes the least recently used ones
+        with _wheelhouse_lock:
+            os.utime(wheelhouse, None)
+            _prune_wheelhouse()
+    except Exception as e:
+        logger.info(f'Could not prefetch the SimNIBS wheel: {e}')
+        return None
+    return wheelhouse
+
+# Wheelhouses used since then may still be needed by concurrent installs
+_start_time = time.time()
+_wheelhouse_lock = threading.Lock()
+
+def _prune_wheelhouse():
+    ''' Removes all but the WHEELHOUSE_VERSIONS most recently used versions,
+    except those used by this run '''
+    root = os.path.join(_cache_dir(), 'wheelhouse')
+    versions = sorted(
+        (os.path.join(root, d) for d in os.listdir(root)),
+        key=os.path.getmtime, reverse=True)
+    for path in versions[WHEELHOUSE_VERSIONS:]:
+        if os.path.getmtime(path) >= _start_time:
+            continue
+        logger.debug(f'Removing {path} from the wheelhouse')
+        shutil.rmtree(path, ignore_errors=True)
+
+def _install_env(backend, prefix, version_url):
+    ''' Creates or updates simnibs_env. Returns the environment file used '''
+    logger.info('Installing the environment')
+    logger.debug(f'Conda executable: {backend.conda_executable}')
+    logger.debug(f'Environment: {backend.env_dir}')
+    env_file = os.path.join(prefix, _env_file())
+    extra_env = {}
+    if MIRROR is not None:
+        # Everything comes from the mirror: its conda channel, and its wheels
+        # for pip, both for SimNIBS and for the pip section of the env file
+        mirror_env_file = os.path.join(prefix, 'mirror_' + _env_file())
+        _mirror_env_file(env_file, mirror_env_file)
+        env_file = mirror_env_file
+        extra_env = {'PIP_NO_INDEX': '1', 'PIP_FIND_LINKS': version_url}
+    _update_env(backend, env_file, prefix, **extra_env)
+    # So that a failure later on does not mean updating the environment again
+    _record_env(backend, env_file, prefix)
+    return env_file
+
+def _install_simnibs(backend, prefix, version_url, env_file, wheelhouse=None):
+    ''' Installs SimNIBS in simnibs_env with pip
+
+    If the wheels were prefetched to wheelhouse, SimNIBS is installed from
+    them without going to the network
+    '''
+    logger.info('Installing SimNIBS')
+    logger.debug(f'Download URL: {version_url}')
+    if MIRROR is not None:
+        pip_args = f'--no-index -f "{version_url}"'
+    else:
+        pip_args = f'--no-cache-dir -f {version_url}'
+    installed = False
+    if wheelhouse is not None:
+        try:
+            run_command(backend.in_env(
+                'pip', f'install --upgrade --no-index -f "{wheelhouse}" simnibs'))
+            installed = True
+        except OSError:
+            logger.info('Could not install SimNIBS from the wheelhouse, downloading it')
+    if not installed:
+        run_command(backend.in_env(
+            'pip', f'install --upgrade {pip_args} simnibs'))
+    _record_env(backend, env_file, prefix)
+
+
+def _run_postinstall(backend, prefix, silent):
     ''' Run SimNIBS postinstall '''
     logger.info('Running SimNIBS postinstall script')
-    activate_executable = os.path.join(os.path.dirname(conda_executable), 'activate')
-    logger.debug(f'activate executable: {activate_executable}')
+    logger.debug(f'environment: {backend.env_dir}')
     logger.debug(f'target dir: {prefix}') 
-    # We write a shell script and execute it due to the activate calls
+    # postinstall runs from simnibs_env, so the links point to it
     if silent:
         extra_args = '-s -f'
     else:
         extra_args = ''
+    run_command(backend.in_env(
+        'postinstall_simnibs',
+        f'{extra_args} -d "{prefix}" --copy-matlab --setup-links'))
+
+
+def _kill_process_tree(process):
+    ''' Kills a process started by run_command and all its children '''
     if sys.platform == 'win32':
-        run_command(
-            f'call "{activate_executable}" simnibs_env && '
-            f'postinstall_simnibs {extra_args} -d "{prefix}" --copy-matlab --setup-links'
-        )
+        subprocess.call(
+            f'taskkill /F /T /PID {process.pid}',
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        return
+    try:
+        own_group = os.getpgid(process.pid) == process.pid
+    except OSError:
+        # Already finished
+        return
+    if own_group:
+        # Started in its own session, with a timeout
+        os.killpg(process.pid, signal.SIGKILL)
     else:
-        postinstall_executable = os.path.join(
-            os.path.dirname(conda_executable),
-            '..', 'envs', 'simnibs_env', 'bin', 'postinstall_simnibs')
-        run_command(
-            f'"{postinstall_executable}" {extra_args} -d "{prefix}" '
-            '--copy-matlab --setup-links'
-        )
+        # Collect the whole tree first, as the children of a killed process
+        # are reparented
+        pids = [process.pid]
+        for pid in pids:
+            pids += _child_pids(pid)
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except OSError:
+                pass
+
+def _child_pids(pid):
+    try:
+        res = subprocess.check_output(
+            ['pgrep', '-P', str(pid)],
+            stderr=subprocess.DEVNULL, universal_newlines=True)
+    except (OSError, subprocess.CalledProcessError):
+        return []
+    return [int(p) for p in res.split()]
+
+
+def _wait_process(process, timeout=None):
+    ''' Waits for process to finish, returning its resource usage (including
+    the children it waited for) where os.wait4 is avaliable, else None '''
+    if not hasattr(os, 'wait4'):
+        process.wait(timeout=timeout)
+        return None
+    deadline = None if timeout is None else time.monotonic() + timeout
+    while True:
+        pid, status, usage = os.wait4(
+            process.pid, 0 if deadline is None else os.WNOHANG)
+        if pid != 0:
+            break
+        # Only reached with a timeout, after the command closed its output
+        if time.monotonic() > deadline:
+            raise subprocess.TimeoutExpired(process.args, timeout)
+        time.sleep(0.05)
+    if os.WIFSIGNALED(status):
+        process.returncode = -os.WTERMSIG(status)
+    else:
+        process.returncode = os.WEXITSTATUS(status)
+    return usage
 
 
-def run_command(command, log_level=logging.INFO):
+def run_command(command, log_level=logging.INFO, timeout=None, env=None):
     """ Run a command and logs it
+
+    stdout and stderr are read by one thread each, so neither pipe can fill
+    up, and their lines are logged as they arrive. If a timeout (in seconds)
+    is given, the command and its children are killed when it expires
     """
     logger.log(log_level, f'Execute: {command}')
 
@@ -351,20 +2346,64 @@ def run_command(command, log_level=logging.INFO):
         stdout=subprocess.PIPE,
         stderr=subprocess.PIPE,
         stdin=subprocess.DEVNULL,
-        env=ENV, universal_newlines=True,
-        errors='replace'
+        env=ENV if env is None else env, universal_newlines=True,
+        errors='replace',
+        # Own process group, so that a timeout also kills the children.
+        # Otherwise they stay in ours, and get the Ctrl-C of the terminal
+        start_new_session=sys.platform != 'win32' and timeout is not None
     )
-    while command_line_process.returncode is None:
-        command_line_process.poll()
-        for line in command_line_process.stdout:
-            line = line.rstrip('\n')
-            if line != '':
-                logger.log(log_level, line)
-
-    _, stderr = command_line_process.communicate()
-    stderr = stderr
-    if stderr != '':
-        logger.error('\n' + stderr)
+    # Bounded, so that a slow logger blocks the command instead of using memory
+    lines = queue.Queue(maxsize=RUN_COMMAND_BUFFER)
+
+    def pump(stream, level):
+        with stream:
+            for line in stream:
+                lines.put((level, line.rstrip('\n')))
+        lines.put(None)
+
+    readers = [
+        threading.Thread(
+            target=pump, args=(command_line_process.stdout, log_level),
+            daemon=True),
+        threading.Thread(
+            target=pump, args=(command_line_process.stderr, logging.ERROR),
+            daemon=True),
+    ]
+    for r in readers:
+        r.start()
+
+    deadline = None if timeout is None else time.monotonic() + timeout
+    n_open = len(readers)
+    try:
+        while n_open > 0:
+            remaining = None if deadline is None else max(deadline - time.monotonic(), 0)
+            try:
+                # Wakes up regularly to see if the install was cancelled
+                item = lines.get(timeout=0.5 if remaining is None else min(remaining, 0.5))
+            except queue.Empty:
+                if deadline is not None and time.monotonic() >= deadline:
+                    raise
+                _check_cancelled()
+                continue
+            if item is None:
+                n_open -= 1
+            elif item[1] != '':
+                logger.log(*item)
+        remaining = None if deadline is None else max(deadline - time.monotonic(), 0)
+        usage = _wait_process(command_line_process, remaining)
+    except BaseException as e:
+        # Also on Ctrl-C and other errors, so that nothing is left running
+        _kill_process_tree(command_line_process)
+        command_line_process.wait()
+        if isinstance(e, (queue.Empty, subprocess.TimeoutExpired)):
+            raise TimeoutError(
+                f'Command did not finish in {timeout} seconds: {command}')
+        raise
+
+    if usage is not None:
+        _count('child_cpu_time', usage.ru_utime + usage.ru_stime)
+        _count('child_peak_rss', _maxrss_bytes(usage.ru_maxrss), max)
+
     if command_line_process.returncode == 0:
         logger.debug('Execution finished')
 
@@ -372,6 +2411,144 @@ def run_command(command, log_level=logging.INFO):
         raise OSError(f'Error executing command: {command}')
 
 
+def _is_platform_wheel(name):
+    ''' Checks if name is a wheel which can be installed in this platform '''
+    if not name.endswith('.whl'):
+        return False
+    platform_tag = name[:-len('.whl')].split('-')[-1]
+    if platform_tag == 'any':
+        return True
+    if sys.platform == 'linux':
+        return platform_tag.startswith(('linux', 'manylinux'))
+    elif sys.platform == 'darwin':
+        return platform_tag.startswith('macosx')
+    elif sys.platform == 'win32':
+        return platform_tag.startswith('win')
+    else:
+        raise OSError('OS not supported')
+
+def _build_channel(pkgs_dir, channel_dir):
+    ''' Adds the packages downloaded by conda to pkgs_dir to a local channel
+
+    The repodata is assembled from the repodata_record.json conda leaves in
+    each extracted package, so conda-build is not needed '''
+    repodata = {}
+    for subdir in os.listdir(channel_dir) if os.path.isdir(channel_dir) else []:
+        repodata_fn = os.path.join(channel_dir, subdir, 'repodata.json')
+        if os.path.isfile(repodata_fn):
+            with open(repodata_fn, 'r') as f:
+                repodata[subdir] = json.load(f)
+    n_packages = 0
+    for name in os.listdir(pkgs_dir):
+        record_fn = os.path.join(pkgs_dir, name, 'info', 'repodata_record.json')
+        if not os.path.isfile(record_fn):
+            continue
+        with open(record_fn, 'r') as f:
+            record = json.load(f)
+        fn = record['fn']
+        if not os.path.isfile(os.path.join(pkgs_dir, fn)):
+            continue
+        subdir = record['subdir']
+        os.makedirs(os.path.join(channel_dir, subdir), exist_ok=True)
+        shutil.copyfile(
+            os.path.join(pkgs_dir, fn), os.path.join(channel_dir, subdir, fn))
+        # These point to the original channel
+        for key in ['channel', 'url', 'fn', 'auth']:
+            record.pop(key, None)
+        key = 'packages.conda' if fn.endswith('.conda') else 'packages'
+        repodata.setdefault(
+            subdir,
+            {'info': {'subdir': subdir}, 'packages': {}, 'packages.conda': {}}
+        )[key][fn] = record
+        n_packages += 1
+    # conda always looks for a noarch subdir
+    repodata.setdefault(
+        'noarch',
+        {'info': {'subdir': 'noarch'}, 'packages': {}, 'packages.conda': {}})
+    for subdir, data in repodata.items():
+        os.makedirs(os.path.join(channel_dir, subdir), exist_ok=True)
+        with open(os.path.join(channel_dir, subdir, 'repodata.json'), 'w') as f:
+            json.dump(data, f)
+    logger.info(f'Added {n_packages} conda packages to the bundle')
+
+def run_bundle(bundle_dir, simnibs_version, pre_release):
+    ''' Downloads everything needed to install a SimNIBS version offline
+
+    The bundle can be used with --mirror, as a directory or served over HTTP.
+    It contains
+        releases.json: release data for the bundled versions
+        assets/<tag>/: environment file, documentation and wheels
+        miniconda/: the Miniconda installer
+        channel/: conda channel with the packages in the environment
+    Bundling several versions in the same directory is supported
+    '''
+    bundle_dir = os.path.abspath(bundle_dir)
+    catalogue = _get_catalogue(GH_RELEASES_URL, pre_release)
+    if simnibs_version == 'latest':
+        version = catalogue.latest()
+    else:
+        version = simnibs_version
+    try:
+        release_data = catalogue.release(version)
+    except KeyError:
+        ver_string = '\n'.join(catalogue.versions())
+        raise ValueError(
+            f'Could not find requested SimNIBS version: {simnibs_version}'
+            f'\nAvaliable versions are:\n{ver_string}')
+    tag = release_data['tag_name']
+    logger.info(f'Bundling SimNIBS {version} in {bundle_dir}')
+
+    assets_dir = os.path.join(bundle_dir, 'assets', tag)
+    os.makedirs(assets_dir, exist_ok=True)
+    asset_names = [_env_file(), 'documentation.zip'] + [
+        name for name in catalogue.asset_names(version) if _is_platform_wheel(name)]
+    for name in asset_names:
+        logger.info(f'Downloading {name}')
+        _download_asset(catalogue, version, name, os.path.join(assets_dir, name))
+
+    os.makedirs(os.path.join(bundle_dir, 'miniconda'), exist_ok=True)
+    miniconda_installer_path = os.path.join(
+        bundle_dir, 'miniconda', _miniconda_installer_name())
+    _download_miniconda(miniconda_installer_path)
+
+    # Let conda solve and download the environment in a throwaway Miniconda,
+    # then turn the downloaded packages into a channel
+    logger.info('Downloading the conda packages')
+    with tempfile.TemporaryDirectory() as tmpdir:
+        miniconda_dir = os.path.join(tmpdir, 'miniconda3')
+        env_dir = os.path.join(tmpdir, 'env')
+        pkgs_dir = os.path.join(tmpdir, 'pkgs')
+        _install_miniconda(miniconda_installer_path, miniconda_dir)
+        if sys.platform == 'win32':
+            conda_executable = os.path.join(miniconda_dir, 'Scripts', 'conda.exe')
+            pip_executable = os.path.join(env_dir, 'Scripts', 'pip.exe')
+        else:
+            conda_executable = os.path.join(miniconda_dir, 'bin', 'conda')
+            pip_executable = os.path.join(env_dir, 'bin', 'pip')
+        env_file = os.path.join(assets_dir, _env_file())
+        run_command(
+            f'"{conda_executable}" env create -p "{env_dir}" -f "{env_file}"',
+            env=_child_env(CONDA_PKGS_DIRS=pkgs_dir))
+        _build_channel(pkgs_dir, os.path.join(bundle_dir, 'channel'))
+        # Wheels for the pip section of the environment and for the SimNIBS
+        # dependencies not in the environment
+        _, _, pip_dependencies = _read_env_file(env_file)
+        pip_specs = ' '.join(f'"{d}"' for d in pip_dependencies)
+        run_command(
+            f'"{pip_executable}" download -d "{assets_dir}" -f "{assets_dir}" '
+            f'{pip_specs} "simnibs=={version}"')
+
+    releases_fn = os.path.join(bundle_dir, 'releases.json')
+    releases = []
+    if os.path.isfile(releases_fn):
+        with open(releases_fn, 'r') as f:
+            releases = [r for r in json.load(f) if r['tag_name'] != tag]
+    releases.append(release_data)
+    releases.sort(key=lambda r: Version(r['tag_name'][1:]), reverse=True)
+    with open(releases_fn, 'w') as f:
+        json.dump(releases, f)
+    logger.info(f'SimNIBS {version} bundled in {bundle_dir}')
+
 
 def run_install(prefix, simnibs_version, pre_release, silent):
     ''' Main function for installation
@@ -388,24 +2565,258 @@ def run_install(prefix, simnibs_version, pre_release, silent):
     if not os.path.isdir(prefix):
         os.makedirs(prefix)
 
-    # Add a logger
+    # Add a logger, which only gets the records of this install
+    _context.prefix = prefix
     fh = logging.FileHandler(os.path.join(prefix, 'simnibs_install_log.txt'), mode='w')
     formatter = logging.Formatter(
         '[ %(name)s - %(asctime)s ]%(levelname)s: %(message)s')
     fh.setFormatter(formatter)
     fh.setLevel(logging.DEBUG)
+    fh.addFilter(_PrefixFilter(prefix))
     logger.addHandler(fh)
+    _context.profile = InstallProfile()
+    try:
+        _run_install(prefix, simnibs_version, pre_release, silent)
+    except Exception as e:
+        # Goes only to the log file, the caller reports it
+        logger.debug(f'Installation failed: {e}', exc_info=True)
+        raise
+    finally:
+        _context.profile.log_summary(logging.INFO if PROFILE else logging.DEBUG)
+        if PROFILE:
+            report_fn = os.path.join(prefix, 'simnibs_install_report.json')
+            _context.profile.write(report_fn)
+            logger.info(f'Install report written to {report_fn}')
+        logger.removeHandler(fh)
+        fh.close()
+        _context.prefix = None
+        _context.profile = None
+
+def _run_phases(phases, jobs=None, checkpoint=None):
+    ''' Runs a DAG of install phases, in parallel where possible
+
+    Parameters
+    ------------
+    phases: list
+        (name, function, dependencies) or (name, function, dependencies,
+        inputs) tuples. A phase starts once all its dependencies finished,
+        and gets their results as arguments. inputs is called with the same
+        arguments, and returns what the phase depends on, as a JSON-able
+        object
+    jobs: int
+        Maximum number of phases running at once. Default: INSTALL_JOBS
+    checkpoint: Checkpoint
+        Phases with inputs are recorded in it when they finish, and skipped
+        (using the recorded result) if they finished before with the same
+        inputs
+
+    Returns
+    --------
+    results: dict
+        Results of the phases, by name
+
+    Raises
+    -------
+    If phases fail, no new phases are started, and once the running ones
+    finish the error of the first failed phase in the list is raised. On
+    Ctrl-C (or another error in this thread) the running phases are cancelled,
+    and the error is raised right away
+    '''
+    names = [phase[0] for phase in phases]
+    results = {}
+    errors = {}
+    times = {}
+    pending = list(phases)
+    running = {}
+
+    def run_phase(name, func, args):
+        start = time.perf_counter()
+        try:
+            with _phase(name):
+                return func(*args)
+        finally:
+            times[name] = (start, time.perf_counter())
+
+    # Set on Ctrl-C, so that the running phases stop instead of being waited for
+    cancel = threading.Event()
+    previous_cancel = getattr(_context, 'cancel', None)
+    _context.cancel = cancel
+    executor = concurrent.futures.ThreadPoolExecutor(jobs or INSTALL_JOBS)
+    try:
+        while True:
+            # Skipped phases can unblock others, so look again until none is
+            started = True
+            while started and not errors:
+                started = False
+                for phase in list(pending):
+                    name, func, deps = phase[:3]
+                    if not all(d in results for d in deps):
+                        continue
+                    pending.remove(phase)
+                    started = True
+                    args = [results[d] for d in deps]
+                    if checkpoint is not None and len(phase) > 3:
+                        done, result = checkpoint.get(name, phase[3](*args))
+                        if done:
+                            logger.info(f'Skipping {name}, it was completed before')
+                            results[name] = result
+                            continue
+                    if running:
+                        logger.debug(
+                            f'Starting {name}, in parallel with '
+                            + ', '.join(p[0] for p, _ in running.values()))
+                    future = executor.submit(_in_context(run_phase), name, func, args)
+                    running[future] = (phase, args)
+            if not running:
+                break
+            finished, _ = concurrent.futures.wait(
+                running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in finished:
+                phase, args = running.pop(future)
+                name = phase[0]
+                if future.exception() is not None:
+                    errors[name] = future.exception()
+                    continue
+                results[name] = future.result()
+                if checkpoint is not None and len(phase) > 3:
+                    # The inputs as they are after the phase, e.g. the hash
+                    # of the file it downloaded
+                    checkpoint.save(name, phase[3](*args), results[name])
+    except BaseException:
+        cancel.set()
+        for future in running:
+            future.cancel()
+        executor.shutdown(wait=False)
+        raise
+    finally:
+        _context.cancel = previous_cancel
+    executor.shutdown()
+
+    parallel = [
+        f'{a} and {b}' for i, a in enumerate(names) for b in names[i + 1:]
+        if a in times and b in times and
+        times[a][0] < times[b][1] and times[b][0] < times[a][1]
+    ]
+    if parallel:
+        logger.info('Ran in parallel: ' + ', '.join(parallel))
+    for name in names:
+        if name in errors:
+            raise errors[name]
+    if pending:
+        raise ValueError(
+            'Could not run the phases ' + ', '.join(p[0] for p in pending)
+            + ': their dependencies are not satisfied')
+    return results
+
+def _run_install(prefix, simnibs_version, pre_release, silent):
+    if RESTART:
+        with _edit_state(prefix) as state:
+            state.pop('checkpoint', None)
+            state.pop('environment', None)
+    with _phase('metadata'):
+        requested_version = _check_versions(prefix, simnibs_version, pre_release)
+    if requested_version is None:
+        return
+
+    logger.info(f'Installing SimNBIS to: {prefix}')
+    v = requested_version
+    checkpoint = Checkpoint(prefix, v)
+    env_fn = os.path.join(prefix, _env_file())
+    docs_manifest = os.path.join(prefix, 'documentation', '.manifest.json')
+    docs_mode = _docs_mode(prefix)
+    _run_phases([
+        # name, function, dependencies (their results are the arguments) and,
+        # for phases which can be skipped when resuming, their inputs. The
+        # phases using the URL env_file returns depend on it, as it changes
+        # with --mirror
+        ('conda_base', lambda: _get_backend(prefix), []),
+        ('env_file', lambda: _download_env_file(v, prefix, pre_release), [],
+         lambda: {'asset': _asset_fingerprint(v, pre_release, _env_file()),
+                  'sha256': _file_sha256(env_fn),
+                  'mirror': MIRROR}),
+        ('docs', lambda: _install_docs(v, prefix, pre_release, docs_mode), [],
+         lambda: {'mode': docs_mode,
+                  'asset': _asset_fingerprint(v, pre_release, 'documentation.zip'),
+                  'manifest': os.path.isfile(docs_manifest)}),
+        # The mirror has the wheels locally already
+        ('wheel_prefetch',
+         lambda: None if MIRROR is not None else _prefetch_wheels(v, pre_release), []),
+        ('conda_env',
+         lambda backend, url: _install_env(backend, prefix, url),
+         ['conda_base', 'env_file'],
+         lambda backend, url: {'env_dir': backend.env_dir,
+                               'exists': os.path.isdir(backend.env_dir),
+                               'env_file': _file_sha256(env_fn),
+                               'url': url}),
+        ('pip',
+         lambda backend, url, env_file, wheelhouse: _install_simnibs(
+             backend, prefix, url, env_file, wheelhouse),
+         ['conda_base', 'env_file', 'conda_env', 'wheel_prefetch'],
+         lambda backend, url, env_file, wheelhouse: {
+             'env_dir': backend.env_dir,
+             'env_file': _file_sha256(env_file),
+             'url': url}),
+        ('postinstall',
+         lambda backend, pip, docs: _run_postinstall(backend, prefix, silent),
+         ['conda_base', 'pip', 'docs']),
+    ], checkpoint=checkpoint)
+    checkpoint.finish()
+    # Move the installer as 'update_simnibs'
+    target_name = os.path.join(prefix, 'bin', 'update_simnibs' + os.path.splitext(FILENAME)[1])
+    if not os.path.isfile(target_name):
+        shutil.copy(FILENAME, target_name)
+    elif not os.path.samefile(FILENAME, target_name):
+        shutil.copy(FILENAME, target_name)
+
+    logger.info('SimNIBS successfully installed')
+
+def _get_backend(prefix):
+    ''' Sets up the conda install where simnibs_env goes
+
+    By default, Miniconda is installed in the prefix. With --conda (or if a
+    previous install of this prefix used it), simnibs_env is created in the
+    prefix using an existing conda, mamba or micromamba install '''
+    state = _read_state(prefix)
+    location = CONDA
+    if location is None and 'conda' in state:
+        location = state['conda']['executable']
+        if not os.path.isfile(location):
+            raise OSError(
+                f'The conda install used by this SimNIBS install ({location}) '
+                'is gone, select another one with --conda')
+    if location is None:
+        # Check is Miniconda is alteady present
+        miniconda_dir = os.path.join(prefix, 'miniconda3')
+        if sys.platform == 'win32':
+            conda_executable = os.path.join(miniconda_dir, 'Scripts', 'conda.exe')
+        else:
+            conda_executable = os.path.join(miniconda_dir, 'bin', 'conda')
 
+        if os.path.isfile(conda_executable):
+            logger.info('Miniconda installation detected, skipping install step')
+        else:
+            _download_and_install_miniconda(miniconda_dir)
+        return CondaBackend(conda_executable, SOLVER)
+
+    conda_executable = _find_conda(location)
+    backend = CondaBackend(
+        conda_executable, SOLVER,
+        env_dir=os.path.join(prefix, 'simnibs_env'), external=True)
+    logger.info(f'Using the conda install in {backend.base_dir}')
+    with _edit_state(prefix) as state:
+        state['conda'] = {'executable': conda_executable, 'env_dir': backend.env_dir}
+    return backend
+
+def _check_versions(prefix, simnibs_version, pre_release):
+    ''' Finds the version to install. Returns None if it is already installed '''
     # Check the currently avaliable versisons
-    avaliable_versions, _ = _get_versions(GH_RELEASES_URL, pre_release)
+    catalogue = _get_catalogue(GH_RELEASES_URL, pre_release)
     if simnibs_version == 'latest':
-        requested_version = list(avaliable_versions.keys())[0]
+        requested_version = catalogue.latest()
     else:
         requested_version = simnibs_version
-    try:
-        requested_idx = avaliable_versions[requested_version]
-    except KeyError:
-        ver_string = '\n'.join(avaliable_versions.keys())
+    if requested_version not in catalogue:
+        ver_string = '\n'.join(catalogue.versions())
         raise ValueError(
             f'Could not find requested SimNIBS version: {simnibs_version}'
             f'\nAvaliable versions are:\n{ver_string}')
@@ -414,330 +2825,517 @@ def run_install(prefix, simnibs_version, pre_release, silent):
     if os.path.isfile(_simnibs_exe(prefix)):
         logger.info('SimNIBS installation detected! Updating it')
         curr_version = _get_current_version(prefix)
-        try:
-            curr_idx = avaliable_versions[curr_version]
-        except KeyError:
-            curr_idx = len(avaliable_versions) + 1
+        if _parse_version(curr_version) is None:
             logger.info('Could not determine the current SimNIBS version')
             logger.info('Updating to the latest version')
         else:
-            if requested_idx > curr_idx:
+            if Version(requested_version) < Version(curr_version):
                 raise ValueError(
                     "Can't downgrade SimNIBS!\n"
                     f"current version: {curr_version}\n"
                     f"requested version: {requested_version}\n")
-            elif curr_idx == requested_idx:
-                logger.info('SimNIBS is already in the requested version')
-                return
+            elif Version(requested_version) == Version(curr_version):
+                if _read_state(prefix).get('checkpoint', {}).get('version') == requested_version:
+                    logger.info('Finishing an incomplete install of this version')
+                else:
+                    logger.info('SimNIBS is already in the requested version')
+                    return None
             else:
                 logger.info(f'Updating SimNIBS {curr_version} -> {requested_version}')
     else:
         logger.debug('did not find any SimNIBS install in the target folder')
         logger.info(f'Installing SimNIBS {requested_version}')
+    return requested_version
 
 
-    logger.info(f'Installing SimNBIS to: {prefix}')
-    # Check is Miniconda is alteady present
-    miniconda_dir = os.path.join(prefix, 'miniconda3')
-    if sys.platform == 'win32':
-        conda_executable = os.path.join(miniconda_dir, 'Scripts', 'conda.exe')
-    else:
-        conda_executable = os.path.join(miniconda_dir, 'bin', 'conda')
+def run_fleet(manifest_fn, jobs):
+    ''' Installs SimNIBS into several prefixes concurrently
 
-    if os.path.isfile(conda_executable):
-        logger.info('Miniconda installation detected, skipping install step')
-    else:
-        _download_and_install_miniconda(miniconda_dir)
-    # Install SimNIBS
-    url = _download_env_docs(requested_version, prefix, pre_release)
-    _install_env_and_simnibs(url, conda_executable, prefix)
-    _run_postinstall(conda_executable, prefix, silent)
-    # Move the installer as 'update_simnibs'
-    target_name = os.path.join(prefix, 'bin', 'update_simnibs' + os.path.splitext(FILENAME)[1])
-    if not os.path.isfile(target_name):
-        shutil.copy(FILENAME, target_name)
-    elif not os.path.samefile(FILENAME, target_name):
-        shutil.copy(FILENAME, target_name)
+    The manifest is a JSON list of objects with the keys "prefix", "version"
+    (default: latest) and "pre_release" (default: false). All the installs
+    share one conda package cache, and each prefix gets its own log file
+    '''
+    with open(manifest_fn, 'r') as f:
+        installs = json.load(f)
+    prefixes = [os.path.abspath(i['prefix']) for i in installs]
+    if len(set(prefixes)) != len(prefixes):
+        raise ValueError('The same prefix is listed more than once in the manifest')
+
+    global ENV, PKGS_SHARED
+    pkgs_dir = os.path.join(_cache_dir(), 'pkgs')
+    os.makedirs(pkgs_dir, exist_ok=True)
+    ENV = _child_env(CONDA_PKGS_DIRS=pkgs_dir)
+    PKGS_SHARED = True
+    sh.setFormatter(logging.Formatter(
+        '[ %(name)s | %(prefix)s ]%(levelname)s: %(message)s'))
+    logger.info(
+        f'Installing SimNIBS into {len(installs)} prefixes, {jobs} at a time')
+    logger.info(f'Shared package cache: {pkgs_dir}')
+
+    def install(entry):
+        start = time.time()
+        # Several installs write to the console at once, so no progress bars
+        _context.on_progress = CliProgress(False)
+        run_install(
+            entry['prefix'], entry.get('version', 'latest'),
+            entry.get('pre_release', False), True)
+        return time.time() - start
+
+    with concurrent.futures.ThreadPoolExecutor(jobs) as executor:
+        futures = [executor.submit(install, entry) for entry in installs]
+        concurrent.futures.wait(futures)
+    env_dirs = []
+    for prefix in prefixes:
+        env_dirs += _conda_envs(os.path.join(prefix, 'miniconda3'))
+        env_dirs.append(os.path.join(prefix, 'simnibs_env'))
+    _prune_pkgs(pkgs_dir, env_dirs)
+
+    n_failed = 0
+    logger.info('Summary:')
+    for entry, future in zip(installs, futures):
+        version = entry.get('version', 'latest')
+        if future.exception() is None:
+            logger.info(
+                f"  {entry['prefix']} ({version}): OK in {future.result():.0f} s")
+        else:
+            n_failed += 1
+            logger.error(
+                f"  {entry['prefix']} ({version}): FAILED ({future.exception()}), "
+                f"see {os.path.join(entry['prefix'], 'simnibs_install_log.txt')}")
+    if n_failed > 0:
+        raise OSError(f'{n_failed} of {len(installs)} installs failed')
 
-    logger.info('SimNIBS successfully installed')
 
+class LogBuffer(logging.Handler):
+    ''' Keeps the last max_lines log messages until they are drained
 
-class InstallGUI(QtWidgets.QWizard):
-    ''' Installation wizard '''
-    def __init__(self,
-                 prefix,
-                 simnibs_version='latest',
-                 pre_release=False):
+    Lets the GUI show the log in batches, instead of once per record '''
+    def __init__(self, max_lines):
         super().__init__()
-        self.prefix = prefix
-        self.simnibs_version = simnibs_version
-        self.pre_release = pre_release
-        self.successful = False
-
-        # Button layout without the back button
-
-        buttons_layout = []
-        buttons_layout.append(QtWidgets.QWizard.Stretch )
-        buttons_layout.append(QtWidgets.QWizard.NextButton )
-        buttons_layout.append(QtWidgets.QWizard.FinishButton)
-        buttons_layout.append(QtWidgets.QWizard.CancelButton )
-        self.setButtonLayout(buttons_layout)
-
-        self.button(QtWidgets.QWizard.CancelButton).disconnect()
-        self.button(QtWidgets.QWizard.CancelButton).clicked.connect(self.cancel)
-        self.page_options = 0
-        self.page_install = 1
-        self.page_finish = 2
-        self.page_error = 3
-        self.setPage(self.page_options, self.options_page())
-        self.setPage(self.page_install, self.install_page())
-        self.setPage(self.page_finish, self.finish_page())
-        self.setPage(self.page_error, self.error_page())
-        #self.setStartID(self.Page_options)
-        self.setWindowTitle(f'SimNIBS Installer {__version__}')
+        self.lines = collections.deque(maxlen=max_lines)
+        self.n_dropped = 0
+
+    def emit(self, record):
+        # Called with the handler lock held
+        message = self.format(record)
+        if len(self.lines) == self.lines.maxlen:
+            self.n_dropped += 1
+        self.lines.append(message)
+
+    def drain(self):
+        ''' Returns the messages logged since the last call, and how many
+        were dropped as there were more than max_lines '''
+        self.acquire()
         try:
-            curdir = sys._MEIPASS
-        except:
-            curdir = '.'
-        self.setWindowIcon(
-            QtGui.QIcon(os.path.join(curdir, 'gui_icon.ico')))
-
-        if sys.platform == 'darwin':
-            self.setWizardStyle(QtWidgets.QWizard.MacStyle)
-        else:
-            self.setWizardStyle(QtWidgets.QWizard.ModernStyle)
+            lines = list(self.lines)
+            n_dropped = self.n_dropped
+            self.lines.clear()
+            self.n_dropped = 0
+        finally:
+            self.release()
+        return lines, n_dropped
+
+def _get_example_url():
+    ''' URL of the example dataset in its latest release '''
+    latest_release = _get_json(
+        'https://api.github.com/repos/simnibs/example-dataset/releases')[0]
+    for asset in latest_release['assets']:
+        if asset['name'] == 'simnibs_examples.zip':
+            return asset['browser_download_url']
+    raise ValueError('Could not find the example dataset')
+
+def _finish_text(example_url):
+    if example_url is None:
+        example_url = 'https://simnibs.github.io/simnibs/build/html/dataset.html'
+    return (
+        f'<font size="+1">'
+        f'To learn more about SimNIBS, please'
+        f'<ul>'
+        f'<li> <a href="https://simnibs.github.io/simnibs"> Visit our website </a> </li>'
+        f'<li> <a href="{example_url}"> Download the example dataset </a> </li>'
+        f'<li> <a href="https://simnibs.github.io/simnibs/build/html/tutorial/gui.html"> Follow the tutorial </a>'
+        f'</ul>'
+        f'</font>'
+        )
 
-    def nextId(self):
-        if self.currentId() == self.page_install:
-            if self.successful:
-                return self.page_finish
-            else:
-                return self.page_error
-        elif self.currentId() == self.page_finish:
-            return -1
-        elif self.currentId() == self.page_error:
-            return -1
-        else:
-            return self.currentId() + 1
+# The GUI classes are defined by _load_gui
+InstallGUI = None
+InstallerThread = None
+ReleaseFetcher = None
 
-    def cancel(self):
-        answ = QtWidgets.QMessageBox.question(
-            self, 'SimNIBS installation',
-            'Are you sure you want to cancel the installation?',
-            QtWidgets.QMessageBox.Yes | QtWidgets.QMessageBox.No,
-            QtWidgets.QMessageBox.No)
-        if answ == QtWidgets.QMessageBox.Yes:
-            self.reject()
-
-    def options_page(self):
-        ''' First page, where options are set '''
-        options_page = QtWidgets.QWizardPage()
-        options_page.setTitle('Installation Options')
-        options_page.setSubTitle(
-            'The installer will donwload and install SimNIBS and its requiremets.\n'
-            'The final installation requires about 3 GB of space')
-        layout = QtWidgets.QGridLayout()
-
-        layout.addWidget(QtWidgets.QLabel('Install Directory:'), 0, 0)
-        self.prefix_line_edit = QtWidgets.QLineEdit()
-        if self.prefix is not None:
-            self.prefix_line_edit.setText(self.prefix)
-            self.prefix_line_edit.textChanged.connect(self.set_prefix)
-        layout.addWidget(self.prefix_line_edit, 0, 1)
-
-        select_file = QtWidgets.QPushButton('&Browse')
-        select_file.clicked.connect(self.select_dir)
-        layout.addWidget(select_file, 0, 2)
-
-
-        layout.addWidget(QtWidgets.QLabel('Version to install:'), 1, 0)
-        version_box = QtWidgets.QComboBox()
-        version_box.activated.connect(self.set_simnibs_version)
-        self.avaliable_versions, _ = _get_versions(GH_RELEASES_URL, self.pre_release)
-        latest_version = list(self.avaliable_versions.keys())[0]
-        if self.simnibs_version == 'latest':
-           selected_version = latest_version
-        else:
-           try:
-                self.avaliable_versions[self.simnibs_version]
-           except KeyError:
-                logger.warn(
-                    f'Could not find requested SimNIBS version: {self.simnibs_version}')
-                selected_version = latest_version
-
-        version_box.addItems(list(self.avaliable_versions.keys()))
-        version_box.setCurrentIndex(list(self.avaliable_versions.keys()).index(selected_version))
-        layout.addWidget(version_box, 1, 1)
-
-        license_label = QtWidgets.QLabel(
-            'I Agree to the <a href="https://raw.githubusercontent.com/simnibs/simnibs/master/LICENSE.txt"> SimNIBS </a>'
-            ' and <a href="https://docs.continuum.io/anaconda/eula"> Miniconda </a> licenses')
-        license_label.setOpenExternalLinks(True)
-        layout.addWidget(license_label, 2, 1)
-        license = QtWidgets.QCheckBox()
-        layout.addWidget(license, 2, 2)
-
-        options_page.registerField("license*", license)
-
-        options_page.setLayout(layout)
-        return options_page
-
-
-    def set_prefix(self, new_value):
-        self.prefix = new_value
-
-    def select_dir(self):
-        self.prefix = str(QtWidgets.QFileDialog.getExistingDirectory(self, "Select Directory"))
-        if self.prefix:
-            self.prefix_line_edit.setText(self.prefix)
-
-    def set_simnibs_version(self, index):
-        self.simnibs_version = list(self.avaliable_versions.keys())[index]
-
-    def install_page(self):
-        ''' Second page, with the install output '''
-        install_page = QtWidgets.QWizardPage()
-        layout = QtWidgets.QGridLayout()
-
-        text_box = QtWidgets.QTextEdit()
-        text_box.setReadOnly(True)
-        text_box.setAcceptRichText(True)
-
-
-        layout.addWidget(text_box)
-        install_page.setLayout(layout)
-
-
-        self.install_thread = None
-        self.successful = False
-        def start_thread():
-            ''' Starts the install procedure '''
-            self.install_thread = InstallerThread(
-                self.prefix, self.simnibs_version, self.pre_release)
-            self.install_thread.start()
-            self.install_thread.out_signal.connect(text_box.append)
-            self.install_thread.final_message.connect(set_final_message)
-            self.install_thread.finished.connect(install_page.completeChanged.emit)
-
-        def set_final_message(successful, msg):
-            if successful:
-                QtWidgets.QMessageBox.information(
-                    self, 'SimNIBS Installation', msg)
-                self.successful = True
-            else:
-                QtWidgets.QMessageBox.critical(
-                    self, 'SimNIBS Installation Error', msg)
-                self.successful = False
+def _load_gui():
+    ''' Imports Qt and defines the GUI classes. Qt takes a long time to load,
+    so this is only done when the GUI is used '''
+    global InstallGUI, InstallerThread, ReleaseFetcher
+    if InstallGUI is not None:
+        return
 
-        def install_finished():
-            ''' Changes the status '''
-            if self.install_thread is None:
-                return False
+    class InstallGUI(QtWidgets.QWizard):
+        ''' Installation wizard '''
+        def __init__(self,
+                     prefix,
+                     simnibs_version='latest',
+                     pre_release=False):
+            super().__init__()
+            self.prefix = prefix
+            self.simnibs_version = simnibs_version
+            self.pre_release = pre_release
+            self.successful = False
+            self.fetcher = ReleaseFetcher(self)
+
+            # Button layout without the back button
+
+            buttons_layout = []
+            buttons_layout.append(QtWidgets.QWizard.Stretch )
+            buttons_layout.append(QtWidgets.QWizard.NextButton )
+            buttons_layout.append(QtWidgets.QWizard.FinishButton)
+            buttons_layout.append(QtWidgets.QWizard.CancelButton )
+            self.setButtonLayout(buttons_layout)
+
+            self.button(QtWidgets.QWizard.CancelButton).disconnect()
+            self.button(QtWidgets.QWizard.CancelButton).clicked.connect(self.cancel)
+            self.page_options = 0
+            self.page_install = 1
+            self.page_finish = 2
+            self.page_error = 3
+            self.setPage(self.page_options, self.options_page())
+            self.setPage(self.page_install, self.install_page())
+            self.setPage(self.page_finish, self.finish_page())
+            self.setPage(self.page_error, self.error_page())
+            #self.setStartID(self.Page_options)
+            self.setWindowTitle(f'SimNIBS Installer {__version__}')
+            try:
+                curdir = sys._MEIPASS
+            except:
+                curdir = '.'
+            self.setWindowIcon(
+                QtGui.QIcon(os.path.join(curdir, 'gui_icon.ico')))
+
+            if sys.platform == 'darwin':
+                self.setWizardStyle(QtWidgets.QWizard.MacStyle)
+            else:
+                self.setWizardStyle(QtWidgets.QWizard.ModernStyle)
+            self.finished.connect(self.fetcher.shutdown)
+
+        def nextId(self):
+            if self.currentId() == self.page_install:
+                if self.successful:
+                    return self.page_finish
+                else:
+                    return self.page_error
+            elif self.currentId() == self.page_finish:
+                return -1
+            elif self.currentId() == self.page_error:
+                return -1
             else:
-                return self.install_thread.isFinished()
-
-        install_page.initializePage = start_thread
-        install_page.isComplete = install_finished
-        
-
-        return install_page
-
-    def finish_page(self):
-        finish_page = QtWidgets.QWizardPage()
-        finish_page.setTitle('Installation Successful')
-
-        latest_release = _get_versions(
-            'https://api.github.com/repos/simnibs/example-dataset/releases')[1][0]
-        example_url = None
-        for asset in latest_release['assets']:
-            if asset['name'] == 'simnibs_examples.zip':
-                example_url = asset['browser_download_url']
-        if example_url is None:
-            example_url = 'https://simnibs.github.io/simnibs/build/html/dataset.html'
-
-
-        layout = QtWidgets.QVBoxLayout()
-        text = QtWidgets.QLabel(
-            f'<font size="+1">'
-            f'To learn more about SimNIBS, please'
-            f'<ul>'
-            f'<li> <a href="https://simnibs.github.io/simnibs"> Visit our website </a> </li>'
-            f'<li> <a href="{example_url}"> Download the example dataset </a> </li>'
-            f'<li> <a href="https://simnibs.github.io/simnibs/build/html/tutorial/gui.html"> Follow the tutorial </a>'
-            f'</ul>'
-            f'</font>'
-            )
-        text.setOpenExternalLinks(True)
-        text.setWordWrap(True)
-        layout.addWidget(text)
-
-        finish_page.setLayout(layout)
-        return finish_page
-
-    def error_page(self):
-        error_page = QtWidgets.QWizardPage()
-        error_page.setTitle('There was an error installing SimNIBS')
-        def make_layout():
+                return self.currentId() + 1
+
+        def cancel(self):
+            answ = QtWidgets.QMessageBox.question(
+                self, 'SimNIBS installation',
+                'Are you sure you want to cancel the installation?',
+                QtWidgets.QMessageBox.Yes | QtWidgets.QMessageBox.No,
+                QtWidgets.QMessageBox.No)
+            if answ == QtWidgets.QMessageBox.Yes:
+                self.reject()
+
+        def options_page(self):
+            ''' First page, where options are set '''
+            options_page = QtWidgets.QWizardPage()
+            options_page.setTitle('Installation Options')
+            options_page.setSubTitle(
+                'The installer will donwload and install SimNIBS and its requiremets.\n'
+                'The final installation requires about 3 GB of space')
+            layout = QtWidgets.QGridLayout()
+
+            layout.addWidget(QtWidgets.QLabel('Install Directory:'), 0, 0)
+            self.prefix_line_edit = QtWidgets.QLineEdit()
+            if self.prefix is not None:
+                self.prefix_line_edit.setText(self.prefix)
+                self.prefix_line_edit.textChanged.connect(self.set_prefix)
+            layout.addWidget(self.prefix_line_edit, 0, 1)
+
+            select_file = QtWidgets.QPushButton('&Browse')
+            select_file.clicked.connect(self.select_dir)
+            layout.addWidget(select_file, 0, 2)
+
+
+            layout.addWidget(QtWidgets.QLabel('Version to install:'), 1, 0)
+            version_box = QtWidgets.QComboBox()
+            version_box.activated.connect(self.set_simnibs_version)
+            # Filled in by set_versions once the releases are fetched
+            self.avaliable_versions = [self.simnibs_version]
+            version_box.addItems(self.avaliable_versions)
+            version_box.setEnabled(False)
+            layout.addWidget(version_box, 1, 1)
+            version_status = QtWidgets.QLabel('Fetching versions...')
+            layout.addWidget(version_status, 1, 2)
+
+            def set_versions(versions):
+                version_status.setText('')
+                version_box.setEnabled(True)
+                if not versions:
+                    return
+                selected_version = versions[0]
+                if self.simnibs_version not in ['latest', versions[0]]:
+                    if self.simnibs_version in versions:
+                        selected_version = self.simnibs_version
+                    else:
+                        logger.warn(
+                            f'Could not find requested SimNIBS version: {self.simnibs_version}')
+                self.avaliable_versions = versions
+                self.simnibs_version = selected_version
+                version_box.clear()
+                version_box.addItems(versions)
+                version_box.setCurrentIndex(versions.index(selected_version))
+
+            def versions_failed(message):
+                logger.warn(f'Could not fetch the SimNIBS versions: {message}')
+                set_versions([])
+
+            self.fetcher.versions.connect(set_versions)
+            self.fetcher.versions_failed.connect(versions_failed)
+            self.fetcher.fetch_versions(self.pre_release)
+
+            license_label = QtWidgets.QLabel(
+                'I Agree to the <a href="https://raw.githubusercontent.com/simnibs/simnibs/master/LICENSE.txt"> SimNIBS </a>'
+                ' and <a href="https://docs.continuum.io/anaconda/eula"> Miniconda </a> licenses')
+            license_label.setOpenExternalLinks(True)
+            layout.addWidget(license_label, 2, 1)
+            license = QtWidgets.QCheckBox()
+            layout.addWidget(license, 2, 2)
+
+            options_page.registerField("license*", license)
+
+            options_page.setLayout(layout)
+            return options_page
+
+
+        def set_prefix(self, new_value):
+            self.prefix = new_value
+
+        def select_dir(self):
+            self.prefix = str(QtWidgets.QFileDialog.getExistingDirectory(self, "Select Directory"))
+            if self.prefix:
+                self.prefix_line_edit.setText(self.prefix)
+
+        def set_simnibs_version(self, index):
+            self.simnibs_version = self.avaliable_versions[index]
+
+        def install_page(self):
+            ''' Second page, with the install output '''
+            install_page = QtWidgets.QWizardPage()
+            layout = QtWidgets.QGridLayout()
+
+            text_box = QtWidgets.QTextEdit()
+            text_box.setReadOnly(True)
+            text_box.setAcceptRichText(True)
+            # Only the last lines are shown, the full log is in the log file
+            text_box.document().setMaximumBlockCount(GUI_LOG_LINES)
+            log_timer = QtCore.QTimer(install_page)
+            log_timer.setInterval(GUI_LOG_INTERVAL)
+
+            progress_label = QtWidgets.QLabel()
+            progress_bar = QtWidgets.QProgressBar()
+            progress_bar.setRange(0, 1000)
+            progress_bar.setTextVisible(False)
+            progress_bar.hide()
+
+            layout.addWidget(text_box)
+            layout.addWidget(progress_label)
+            layout.addWidget(progress_bar)
+            install_page.setLayout(layout)
+
+
+            self.install_thread = None
+            self.successful = False
+            def start_thread():
+                ''' Starts the install procedure '''
+                self.install_thread = InstallerThread(
+                    self.prefix, self.simnibs_version, self.pre_release)
+                log_timer.start()
+                self.install_thread.start()
+                self.install_thread.progress_signal.connect(set_progress)
+                self.install_thread.final_message.connect(set_final_message)
+                self.install_thread.finished.connect(log_timer.stop)
+                self.install_thread.finished.connect(flush_log)
+                self.install_thread.finished.connect(install_page.completeChanged.emit)
+
+            def flush_log():
+                ''' Shows the records logged since the last call, in one go '''
+                lines, n_dropped = self.install_thread.log_buffer.drain()
+                if n_dropped > 0:
+                    lines.insert(
+                        0, f'... {n_dropped} lines not shown, see '
+                        f'{os.path.join(self.prefix, "simnibs_install_log.txt")}')
+                if lines:
+                    text_box.append('\n'.join(lines))
+            log_timer.timeout.connect(flush_log)
+
+            def set_progress(phase, name, done, total, rate, eta):
+                progress_bar.show()
+                if total > 0:
+                    progress_bar.setRange(0, 1000)
+                    progress_bar.setValue(int(1000 * min(done / total, 1)))
+                else:
+                    # Busy indicator
+                    progress_bar.setRange(0, 0)
+                message = _format_progress(phase, name, done, total, rate, eta)
+                if phase:
+                    message = f'{phase} - {message}'
+                progress_label.setText(message)
+
+            def set_final_message(successful, msg):
+                flush_log()
+                if successful:
+                    QtWidgets.QMessageBox.information(
+                        self, 'SimNIBS Installation', msg)
+                    self.successful = True
+                else:
+                    QtWidgets.QMessageBox.critical(
+                        self, 'SimNIBS Installation Error', msg)
+                    self.successful = False
+
+            def install_finished():
+                ''' Changes the status '''
+                if self.install_thread is None:
+                    return False
+                else:
+                    return self.install_thread.isFinished()
+
+            install_page.initializePage = start_thread
+            install_page.isComplete = install_finished
+
+
+            return install_page
+
+        def finish_page(self):
+            finish_page = QtWidgets.QWizardPage()
+            finish_page.setTitle('Installation Successful')
+
             layout = QtWidgets.QVBoxLayout()
-            text = QtWidgets.QLabel(
-                'Please visit <a href="http://www.simnibs.org"> www.simnibs.org </a> '
-                'for troubleshooting information')
+            text = QtWidgets.QLabel(_finish_text(None))
             text.setOpenExternalLinks(True)
             text.setWordWrap(True)
             layout.addWidget(text)
-            layout.addWidget(QtWidgets.QLabel(
-                'If the error persists, please send the file:'))
-            layout.addWidget(QtWidgets.QLabel(
-                f'{os.path.join(self.prefix, "simnibs_install_log.txt")}'))
-            layout.addWidget(QtWidgets.QLabel(
-                'to support@simnibs.org'))
-            error_page.setLayout(layout)
-
-        error_page.initializePage = make_layout
-        return error_page
 
+            # The link to the example dataset is updated once it is fetched
+            if MIRROR is None:
+                self.fetcher.example_url.connect(
+                    lambda url: text.setText(_finish_text(url)))
+                self.fetcher.fetch_example_url()
+
+            finish_page.setLayout(layout)
+            return finish_page
+
+        def error_page(self):
+            error_page = QtWidgets.QWizardPage()
+            error_page.setTitle('There was an error installing SimNIBS')
+            def make_layout():
+                layout = QtWidgets.QVBoxLayout()
+                text = QtWidgets.QLabel(
+                    'Please visit <a href="http://www.simnibs.org"> www.simnibs.org </a> '
+                    'for troubleshooting information')
+                text.setOpenExternalLinks(True)
+                text.setWordWrap(True)
+                layout.addWidget(text)
+                layout.addWidget(QtWidgets.QLabel(
+                    'If the error persists, please send the file:'))
+                layout.addWidget(QtWidgets.QLabel(
+                    f'{os.path.join(self.prefix, "simnibs_install_log.txt")}'))
+                layout.addWidget(QtWidgets.QLabel(
+                    'to support@simnibs.org'))
+                error_page.setLayout(layout)
+
+            error_page.initializePage = make_layout
+            return error_page
+
+
+
+
+    class ReleaseFetcher(QtCore.QObject):
+        ''' Fetches release data in background threads, so that the wizard
+        opens right away
+
+        Results are delivered through signals, in the GUI thread. Requests
+        time out after GUI_FETCH_TIMEOUT, falling back to cached data '''
+        versions = QtCore.pyqtSignal(list)
+        versions_failed = QtCore.pyqtSignal(str)
+        example_url = QtCore.pyqtSignal(str)
+
+        def __init__(self, parent=None):
+            super().__init__(parent)
+            self.executor = concurrent.futures.ThreadPoolExecutor(2)
+
+        def _submit(self, func, on_result, on_error=None):
+            def job():
+                _context.http_timeout = GUI_FETCH_TIMEOUT
+                return func()
+
+            def done(future):
+                # Runs in the worker thread, emit queues it to the GUI thread
+                try:
+                    if future.exception() is None:
+                        on_result.emit(future.result())
+                    elif on_error is not None:
+                        on_error.emit(str(future.exception()))
+                    else:
+                        logger.debug(f'Background fetch failed: {future.exception()}')
+                except RuntimeError:
+                    # The wizard was closed in the meantime
+                    pass
+
+            self.executor.submit(job).add_done_callback(done)
+
+        def fetch_versions(self, pre_release):
+            self._submit(
+                lambda: _get_catalogue(GH_RELEASES_URL, pre_release).versions(),
+                self.versions, self.versions_failed)
+
+        def fetch_example_url(self):
+            self._submit(_get_example_url, self.example_url)
+
+        def shutdown(self):
+            self.executor.shutdown(wait=False)
+
+    @QtCore.pyqtSlot(str)
+    @QtCore.pyqtSlot(bool, str)
+    class InstallerThread(QtCore.QThread):
+        ''' Thread to install SimNIBS
+
+        The log records are collected in log_buffer, for the GUI to fetch
+        them periodically '''
+        final_message = QtCore.pyqtSignal(bool, str)
+        # phase, file name, bytes done, total bytes, bytes/s, ETA in seconds
+        progress_signal = QtCore.pyqtSignal(str, str, float, float, float, float)
+
+        def __init__(self, prefix, simnibs_version, pre_release):
+            QtCore.QThread.__init__(self)
+            self.prefix = prefix
+            self.simnibs_version = simnibs_version
+            self.pre_release = pre_release
+            # Leaves space in the text box for the note on dropped lines
+            self.log_buffer = LogBuffer(GUI_LOG_LINES - 1)
+            self.log_buffer.setFormatter(logging.Formatter('%(levelname)s: %(message)s'))
+
+        def run(self):
+            logger.addHandler(self.log_buffer)
+            _context.on_progress = self.progress_signal.emit
+            try:
+                run_install(self.prefix, self.simnibs_version, self.pre_release, False)
+            except Exception as e:
+                logger.critical(str(e))
+                self.final_message.emit(False, str(e))
+                raise e
+            else:
+                self.final_message.emit(True, 'Installation Successeful!')
+            finally:
+                _context.on_progress = None
+                logger.removeHandler(self.log_buffer)
 
 
-
-@QtCore.pyqtSlot(str)
-@QtCore.pyqtSlot(bool, str)
-class InstallerThread(QtCore.QThread):
-    ''' Thread to install SimNIBS '''
-    out_signal = QtCore.pyqtSignal(str)
-    final_message = QtCore.pyqtSignal(bool, str)
-
-    def __init__(self, prefix, simnibs_version, pre_release):
-        QtCore.QThread.__init__(self)
-        self.prefix = prefix
-        self.simnibs_version = simnibs_version
-        self.pre_release = pre_release
-
-    def run(self):
-        ''' Write log to box '''
-        class WriteToBoxHandler(logging.StreamHandler):
-            def __init__(self, out_signal):
-                super().__init__()
-                self.out_signal = out_signal
-
-            def emit(self, record):
-                msg = self.format(record)
-                self.out_signal.emit(msg)
-
-        w2b_handler = WriteToBoxHandler(self.out_signal)
-        w2b_handler.setFormatter(logging.Formatter('%(levelname)s: %(message)s'))
-        logger.addHandler(w2b_handler)
-        try:
-            run_install(self.prefix, self.simnibs_version, self.pre_release, False)
-        except Exception as e:
-            logger.critical(str(e))
-            self.final_message.emit(False, str(e))
-            raise e
-        else:
-            self.final_message.emit(True, 'Installation Successeful!')
-        finally:
-            logger.removeHandler(w2b_handler)
-
 def start_gui(prefix, simnibs_version, pre_release):
+    _load_gui()
     app = QtWidgets.QApplication(sys.argv)
     ex = InstallGUI(prefix, simnibs_version, pre_release)
     ex.show()
@@ -763,6 +3361,8 @@ def _get_default_dir():
 
 
 def main():
+    global DOWNLOAD_CONNECTIONS, MIRROR, DOWNLOAD_CACHE_SIZE, SOLVER, PROFILE, CONDA
+    global RESTART, DOCS, PKGS_CACHE_SIZE
     parser = argparse.ArgumentParser(prog="install_simnibs",
                                      description="Installs or updates SimNIBS")
     parser.add_argument('-s', '--silent', action='store_true',
@@ -778,13 +3378,98 @@ def main():
                              " Default: latest version")
     parser.add_argument("--pre-release", action='store_true',
                         help= "Also list pre-release versions")
+    parser.add_argument("--connections", type=int, default=DOWNLOAD_CONNECTIONS,
+                        help="Number of parallel connections used to download"
+                             f" large files. Default: {DOWNLOAD_CONNECTIONS}")
+    parser.add_argument("--solver", choices=['auto'] + SOLVERS, default=SOLVER,
+                        help="Solver used to install the environment. 'auto'"
+                             " uses mamba or libmamba if they are already"
+                             " avaliable. Default: auto")
+    parser.add_argument("--conda", metavar='PATH|auto',
+                        help="Create the SimNIBS environment in the prefix"
+                             " using an existing conda, mamba or micromamba"
+                             " install (its executable or directory), instead"
+                             " of installing Miniconda. 'auto' uses the one"
+                             " in the PATH")
+    parser.add_argument("--restart", action='store_true',
+                        help="Redo all the install steps, instead of resuming"
+                             " a failed install where it stopped")
+    parser.add_argument("--docs", choices=DOCS_MODES,
+                        help="How to install the documentation: 'full'"
+                             " downloads it, 'lazy' leaves a page pointing to"
+                             " --fetch-docs, 'none' skips it. Default: same as"
+                             " the previous install, or full")
+    parser.add_argument("--fetch-docs", action='store_true',
+                        help="Download the documentation of the SimNIBS"
+                             " install in the prefix, if it was installed"
+                             " with --docs lazy or none")
+    parser.add_argument("--profile", action='store_true',
+                        help="Write the time, bytes downloaded and resources"
+                             " used by each phase of the install to"
+                             " simnibs_install_report.json in the prefix")
+    parser.add_argument("--cache-size", type=int, metavar='MB',
+                        default=DOWNLOAD_CACHE_SIZE // 1024 ** 2,
+                        help="Size of the download cache shared between"
+                             f" installs, in MB (0 disables it)."
+                             f" Default: {DOWNLOAD_CACHE_SIZE // 1024 ** 2}")
+    parser.add_argument("--pkgs-cache-size", type=int, metavar='MB',
+                        default=PKGS_CACHE_SIZE // 1024 ** 2,
+                        help="Size of the conda packages kept for later"
+                             " updates, beyond those used by SimNIBS, in MB."
+                             f" Default: {PKGS_CACHE_SIZE // 1024 ** 2}")
+    parser.add_argument("--bundle", metavar='DIR',
+                        help="Download everything needed to install SimNIBS"
+                             " offline to DIR, instead of installing it")
+    parser.add_argument("--mirror", metavar='PATH|URL',
+                        help="Install from a bundle created with --bundle,"
+                             " without contacting GitHub or Anaconda")
+    parser.add_argument("--manifest", metavar='FILE',
+                        help="Install into all the prefixes listed in the JSON"
+                             " file FILE, in silent mode. Each entry has a"
+                             " 'prefix' and optionally a 'version' and"
+                             " 'pre_release'")
+    parser.add_argument("-j", "--jobs", type=int, default=2,
+                        help="Number of concurrent installs with --manifest."
+                             " Default: 2")
     parser.add_argument('--version', action='version', version=__version__)
     args = parser.parse_args(sys.argv[1:])
-    self_update(args.silent)
-    if args.silent:
-        run_install(args.prefix, args.simnibs_version, args.pre_release, True)
-    else:
-        start_gui(args.prefix, args.simnibs_version, args.pre_release)
+    DOWNLOAD_CONNECTIONS = max(args.connections, 1)
+    MIRROR = args.mirror
+    DOWNLOAD_CACHE_SIZE = args.cache_size * 1024 ** 2
+    PKGS_CACHE_SIZE = max(args.pkgs_cache_size, 0) * 1024 ** 2
+    SOLVER = args.solver
+    PROFILE = args.profile
+    CONDA = args.conda
+    RESTART = args.restart
+    DOCS = args.docs
+    if args.fetch_docs:
+        _context.on_progress = CliProgress(sys.stderr.isatty())
+        sh.addFilter(_context.on_progress)
+        fetch_docs(args.prefix)
+        return
+    if not (args.silent or args.bundle or args.manifest) and not _has_gui():
+        parser.error('This build of the installer has no GUI, use --silent')
+    if args.silent or args.bundle is not None:
+        _context.on_progress = CliProgress(sys.stderr.isatty())
+        sh.addFilter(_context.on_progress)
+    if args.bundle is not None:
+        run_bundle(args.bundle, args.simnibs_version, args.pre_release)
+        return
+    update_thread = None
+    if MIRROR is None:
+        apply_staged_update(args.silent or args.manifest is not None, sys.argv[1:])
+        update_thread = start_self_update()
+    try:
+        if args.manifest is not None:
+            run_fleet(args.manifest, max(args.jobs, 1))
+        elif args.silent:
+            run_install(args.prefix, args.simnibs_version, args.pre_release, True)
+        else:
+            start_gui(args.prefix, args.simnibs_version, args.pre_release)
+    finally:
+        # Give a staging download some more time, if the install was quick
+        if update_thread is not None:
+            update_thread.join(SELF_UPDATE_TIMEOUT)
 
 # First scans the current directory for a SimNIBS install
 # Then proposes a new directory